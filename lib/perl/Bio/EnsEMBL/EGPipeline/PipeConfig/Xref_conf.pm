@@ -68,6 +68,8 @@ sub default_options {
     remote_uniprot_db => $self->private_conf('ENSEMBL_REMOTE_UNIPPROT_DB'),
     uniparc_dbm_cache_dir => $self->private_conf('UNIPARC_DBM_CACHE_DIR'),
     uniparc_dbm_cache_name =>  'uniparc_cache.tkh',
+    # Unix socket of a running uniparc_query_server.py, used instead of the query script if set
+    uniparc_query_socket => undef,
 
     replace_all           => 0,
     gene_name_source      => [],
@@ -297,6 +299,7 @@ sub pipeline_analyses {
       -parameters      => {
                             uniparc_dbm_cache => catdir($self->o('uniparc_dbm_cache_dir'), $self->o('uniparc_dbm_cache_name')),
                             dbm_query_script => catdir($self->o('ensembl_production_imported_scripts_dir'), 'uniparc_index', 'query_uniparc_dbm.py'),
+                            uniparc_query_socket => $self->o('uniparc_query_socket'),
                             upi_query_dir      => catdir($self->o('pipeline_dir'), '#species#', 'upi_query'),
                             logic_name  => $self->o('checksum_logic_name'),
                             external_db => $self->o('uniparc_external_db'),
@@ -44,6 +44,7 @@ use Bio::EnsEMBL::DBSQL::DBAdaptor;
 use File::Path qw(make_path);
 use File::Spec::Functions qw(catdir);
 use Digest::MD5;
+use IO::Socket::UNIX;
 
 sub param_defaults {
   my ($self) = @_;
@@ -137,15 +138,22 @@ sub query_cache_and_update_upis {
   }
   close($qfh);
 
-  # run query script
   my $upi_file = catdir($work_dir, "md5_upi.lst");
-  my $log_file = catdir($work_dir, "query.log");
-
-  $self->warning("Fetching UPIs from $dbm_file into $upi_file (log $log_file)");
-  my $cmd = "";
-  $cmd .= "cat $md5_queries | ";
-  $cmd .= "  python $query_py --dbfile $dbm_file > $upi_file 2> $log_file";
-  system($cmd) == 0 or $self->throw("Failed to run '$cmd': $!");
+  my $query_socket = $self->param('uniparc_query_socket');
+  if ($query_socket) {
+    # query a running uniparc_query_server.py
+    $self->warning("Fetching UPIs from server $query_socket into $upi_file");
+    $self->query_server($query_socket, $unique_md5s, $upi_file);
+  } else {
+    # run query script
+    my $log_file = catdir($work_dir, "query.log");
+
+    $self->warning("Fetching UPIs from $dbm_file into $upi_file (log $log_file)");
+    my $cmd = "";
+    $cmd .= "cat $md5_queries | ";
+    $cmd .= "  python $query_py --dbfile $dbm_file > $upi_file 2> $log_file";
+    system($cmd) == 0 or $self->throw("Failed to run '$cmd': $!");
+  }
 
   # extract UPIs, assuming same result for the same MD5
   $self->warning("Extracting UPIs from $upi_file");
@@ -165,6 +173,34 @@ sub query_cache_and_update_upis {
   $self->add_upis($translations, $known_upis);
 }
 
+sub query_server {
+  my ($self, $socket_path, $md5s, $upi_file) = @_;
+  my $batch_size = 5_000;
+
+  my $server = IO::Socket::UNIX->new(Type => SOCK_STREAM(), Peer => $socket_path)
+    or $self->throw("Failed to connect to the UniParc query server '$socket_path': $!");
+  open(my $upifh, ">", $upi_file)
+    or $self->throw("Failed to open '$upi_file': $!");
+
+  # requests: md5s, one per line, then an empty line
+  # answers: the same lines as query_uniparc_dbm.py, then an empty line
+  for (my $i = 0; $i < @$md5s; $i += $batch_size) {
+    my $last = $i + $batch_size - 1;
+    $last = $#$md5s if $last > $#$md5s;
+    print $server join("", map { "$_\n" } @{$md5s}[$i .. $last]), "\n";
+    $server->flush();
+    while (1) {
+      my $line = <$server>;
+      defined $line or $self->throw("Connection closed by the UniParc query server '$socket_path'");
+      last if $line eq "\n";
+      print $upifh $line;
+    }
+  }
+
+  close($upifh);
+  close($server);
+}
+
 sub get_uniq_md5s {
   my ($self, $translations, $store) = @_;
   push @$store,
@@ -14,15 +14,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 import argparse
+import difflib
+import gzip
 import json
+import os
 import re
+import threading
+import time
+import xml.etree.ElementTree as ET
 from unidecode import unidecode
 from pathlib import Path
-from redminelib import Redmine
-from redminelib.resources import Issue as RedmineIssue
-from redminelib.managers import ResourceManager as RedmineResource
+import requests
 
 url = 'https://redmine.apidb.org'
 default_fields = dict(
@@ -32,9 +39,447 @@ default_fields = dict(
 insdc_pattern = r'^GC[AF]_\d{9}(\.\d+)?$'
 accession_api_url = "https://www.ebi.ac.uk/ena/browser/api/xml/%s"
 veupathdb_id = 1976
+datatype_field_id = 94
 
 
-def load_abbrevs(path: str) -> List[str]:
+@dataclass
+class FieldSpec:
+    """How to extract one dataset value from a Redmine custom field.
+
+    The value is stripped, checked, then parsed (the parser can raise an Exception to report a
+    problem).
+    """
+    key: str
+    custom_field: str
+    label: str = ""
+    required: bool = True
+    check: Optional[Callable[[str], bool]] = None
+    parse: Optional[Callable[[str], Any]] = None
+
+    def __post_init__(self) -> None:
+        if not self.label:
+            self.label = self.custom_field
+
+
+@dataclass
+class DatatypeSpec:
+    """Datasets of one Redmine DataType, and the fields to extract for each of them."""
+    name: str
+    datatype: str
+    fields: List[FieldSpec]
+
+
+@dataclass
+class RedmineIssue:
+    """A Redmine issue, from its JSON representation in the REST API."""
+    id: int
+    subject: str = ""
+    updated_on: str = ""
+    custom_fields: List[Dict] = field(default_factory=list)
+    data: Dict[str, Any] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'RedmineIssue':
+        return cls(
+            id=data["id"],
+            subject=data.get("subject", ""),
+            updated_on=data.get("updated_on", ""),
+            custom_fields=data.get("custom_fields", []),
+            data=data,
+        )
+
+
+class Redmine:
+    """Fetch issues from the Redmine REST API.
+
+    The pages of issues are fetched concurrently by a bounded pool of threads. The pages normally
+    include the custom fields of the issues; if they don't, each issue is fetched on its own.
+    If a cache dir is given, the JSON of each issue is stored there, and an issue is only fetched
+    again if its updated_on has changed since it was cached.
+    """
+    page_size = 100
+    retries = 3
+
+    def __init__(self, url: str, key: str, workers: int = 8, cache_dir: Optional[str] = None,
+                 timeout: float = 60) -> None:
+        """
+        Args:
+            url: Base URL of the Redmine server.
+            key: Redmine API key.
+            workers: Maximum number of concurrent requests.
+            cache_dir: Directory to store the issues JSON (no cache if None).
+            timeout: Timeout of each request, in seconds.
+        """
+        self.url = url.rstrip("/")
+        self.key = key
+        self.workers = workers
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.timeout = timeout
+        self.local = threading.local()
+        self.stats = {"requests": 0, "cached": 0, "fetched": 0}
+        self.stats_lock = threading.Lock()
+        # Everything retrieved, for a snapshot
+        self.versions: Dict[int, List[Dict]] = {}
+        self.issues: Dict[int, RedmineIssue] = {}
+        self.queries: List[Dict] = []
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _session(self) -> requests.Session:
+        # One session (and connection pool) per thread
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers["X-Redmine-API-Key"] = self.key
+            self.local.session = session
+        return session
+
+    def get_json(self, path: str, params: Optional[Dict] = None) -> Dict:
+        """Get a JSON document from the Redmine REST API, retrying on transient errors.
+
+        Args:
+            path: Path of the document, from the Redmine URL (e.g. "/issues.json").
+            params: Query parameters.
+
+        Returns:
+            The decoded JSON document.
+        """
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.stats_lock:
+                    self.stats["requests"] += 1
+                response = self._session().get(self.url + path, params=params, timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    response.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(2 ** attempt)
+        response.raise_for_status()
+        return response.json()
+
+    def get_versions(self, project_id: int) -> List[Dict]:
+        """Retrieve the versions of a project.
+
+        Args:
+            project_id: Redmine project id.
+
+        Returns:
+            A list of versions dicts (with an id and a name).
+        """
+        versions = self.get_json(f"/projects/{project_id}/versions.json")["versions"]
+        self.versions[project_id] = versions
+        return versions
+
+    def filter_issues(self, **filters) -> List[RedmineIssue]:
+        """Retrieve all the issues matching some filters, in the order of the Redmine listing.
+
+        The first page gives the number of issues, then the other pages are fetched concurrently.
+        The full issues are then taken from the cache, the pages, or fetched (see _get_issue).
+
+        Args:
+            filters: Redmine filters for the issues (as query parameters of /issues.json).
+
+        Returns:
+            A list of RedmineIssue.
+        """
+        first = self._get_page(filters, 0)
+        offsets = range(self.page_size, first["total_count"], self.page_size)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pages = [first] + list(executor.map(lambda offset: self._get_page(filters, offset), offsets))
+            listed = [issue for page in pages for issue in page["issues"]]
+            issues = list(executor.map(self._get_issue, listed))
+        for issue in issues:
+            self.issues[issue.id] = issue
+        self.queries.append(filters)
+        return issues
+
+    def _get_page(self, filters: Dict, offset: int) -> Dict:
+        params = {**filters, "offset": offset, "limit": self.page_size}
+        return self.get_json("/issues.json", params)
+
+    def _get_issue(self, listed: Dict) -> RedmineIssue:
+        """Get the full issue from the cache if it has not changed since it was cached, or from the
+        page of issues if it has its custom fields, or else from Redmine.
+
+        Args:
+            listed: Issue as listed in a page of issues.
+        """
+        issue_id = listed["id"]
+        cache_file = self.cache_dir / f"{issue_id}.json" if self.cache_dir else None
+        if cache_file and cache_file.exists():
+            with cache_file.open("r") as cache:
+                cached = json.load(cache)
+            if cached.get("updated_on") == listed.get("updated_on"):
+                with self.stats_lock:
+                    self.stats["cached"] += 1
+                return RedmineIssue.from_json(cached)
+
+        if "custom_fields" in listed:
+            data = listed
+        else:
+            data = self.get_json(f"/issues/{issue_id}.json")["issue"]
+            with self.stats_lock:
+                self.stats["fetched"] += 1
+        if cache_file:
+            tmp_file = cache_file.with_suffix(f".{threading.get_ident()}.tmp")
+            with tmp_file.open("w") as cache:
+                json.dump(data, cache)
+            os.replace(tmp_file, cache_file)
+        return RedmineIssue.from_json(data)
+
+    def save_snapshot(self, path: str) -> None:
+        """Write all the issues and versions retrieved so far to a snapshot, for RedmineSnapshot.
+
+        The snapshot is a gzipped JSON-lines file: a header with the versions and the filters of the
+        queries made, then one issue per line (in the Redmine JSON format, with its custom fields).
+
+        Args:
+            path: Path of the snapshot file.
+        """
+        header = {
+            "snapshot": 2,
+            "url": self.url,
+            "date": datetime.now(timezone.utc).isoformat(),
+            "versions": {str(project_id): versions for project_id, versions in self.versions.items()},
+            "queries": self.queries,
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as snapshot:
+            snapshot.write(json.dumps(header) + "\n")
+            for issue in self.issues.values():
+                snapshot.write(json.dumps(issue.data) + "\n")
+
+
+class RedmineSnapshot:
+    """Replay the issues of a snapshot (see Redmine.save_snapshot), with the same interface as Redmine.
+
+    No request is made: the issues are filtered locally. Only the custom field (cf_N) and version
+    (fixed_version_id) filters are applied, with "|" separating alternative values: the snapshot only
+    has the issues that matched the other filters when it was made. A query is refused if the queries
+    of the snapshot don't include all its issues (e.g. for another build).
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path: Path of the snapshot file.
+        """
+        self.path = path
+        self.stats = {"requests": 0, "cached": 0, "fetched": 0}
+        with gzip.open(path, "rt", encoding="utf-8") as snapshot:
+            header = json.loads(snapshot.readline())
+            if header.get("snapshot") != 2:
+                raise Exception(f"Not a Redmine snapshot (version 2): {path}")
+            self.header = header
+            self.issues = [RedmineIssue.from_json(json.loads(line)) for line in snapshot if line.strip()]
+
+    def get_versions(self, project_id: int) -> List[Dict]:
+        versions = self.header["versions"].get(str(project_id))
+        if versions is None:
+            # Made without --build: use the versions of the issues
+            versions = {}
+            for issue in self.issues:
+                version = issue.data.get("fixed_version")
+                if version:
+                    versions[version["id"]] = version
+            versions = list(versions.values())
+        return versions
+
+    def filter_issues(self, **filters) -> List[RedmineIssue]:
+        if not any(self._covers(query, filters) for query in self.header["queries"]):
+            raise Exception(f"The snapshot {self.path} doesn't have all the issues for {filters}:"
+                            " make it with the same options (e.g. --build and --get)")
+        return [issue for issue in self.issues if self._match(issue, filters)]
+
+    @staticmethod
+    def _values(value: Any) -> set:
+        value = value if isinstance(value, (list, tuple, set)) else str(value).split("|")
+        return {str(v) for v in value}
+
+    @classmethod
+    def _covers(cls, query: Dict, filters: Dict) -> bool:
+        """Check if the issues matching some filters are all in the issues of a snapshot query."""
+        for name, value in query.items():
+            if name not in filters or not cls._values(filters[name]) <= cls._values(value):
+                return False
+        return True
+
+    @classmethod
+    def _match(cls, issue: RedmineIssue, filters: Dict) -> bool:
+        for name, value in filters.items():
+            values = cls._values(value)
+            cf_match = re.match(r"^cf_(\d+)$", name)
+            if cf_match:
+                cf_id = int(cf_match.group(1))
+                issue_values = set()
+                for cf in issue.custom_fields:
+                    if cf.get("id") == cf_id:
+                        cf_value = cf.get("value")
+                        cf_values = cf_value if isinstance(cf_value, list) else [cf_value]
+                        issue_values = {str(v) for v in cf_values}
+                if not values & issue_values:
+                    return False
+            elif name == "fixed_version_id":
+                if str(issue.data.get("fixed_version", {}).get("id")) not in values:
+                    return False
+        return True
+
+
+class EnaAccessions:
+    """Check that SRA accessions exist in ENA, with the ENA browser API.
+
+    The accessions are resolved in batches (one request for several accessions), by a bounded pool
+    of threads. The accessions found are stored in a cache file, and are not checked again.
+    """
+    batch_size = 100
+    retries = 3
+
+    def __init__(self, url: str = accession_api_url, workers: int = 4, cache_file: Optional[str] = None,
+                 timeout: float = 60) -> None:
+        """
+        Args:
+            url: URL of the ENA browser API XML view, with a %s for the accessions.
+            workers: Maximum number of concurrent requests.
+            cache_file: JSON file to store the accessions found (no cache if None).
+            timeout: Timeout of each request, in seconds.
+        """
+        self.url = url
+        self.workers = workers
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.timeout = timeout
+        self.local = threading.local()
+        self.stats = {"requests": 0, "cached": 0, "checked": 0}
+        self.stats_lock = threading.Lock()
+        self.found = set()
+        if self.cache_file:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        if self.cache_file and self.cache_file.exists():
+            with self.cache_file.open("r") as cache:
+                self.found = set(json.load(cache))
+
+    def _session(self) -> requests.Session:
+        # One session (and connection pool) per thread
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+    def resolve(self, accessions: Iterable[str]) -> Dict[str, Optional[bool]]:
+        """Check if accessions exist in ENA.
+
+        Args:
+            accessions: SRA accessions to check.
+
+        Returns:
+            A dict of each accession: True if it is in ENA, False if it is not, and None if it could
+            not be checked (after the retries of a failed request).
+        """
+        accessions = list(dict.fromkeys(accessions))
+        results = {acc: True for acc in accessions if acc in self.found}
+        to_check = [acc for acc in accessions if acc not in results]
+        self.stats["cached"] += len(results)
+        self.stats["checked"] += len(to_check)
+
+        batches = [to_check[i:i + self.batch_size] for i in range(0, len(to_check), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch, found in zip(batches, executor.map(self._get_batch, batches)):
+                for acc in batch:
+                    results[acc] = None if found is None else acc in found
+                if found:
+                    self.found.update(found)
+
+        if self.cache_file and to_check:
+            tmp_file = self.cache_file.with_suffix(".tmp")
+            with tmp_file.open("w") as cache:
+                json.dump(sorted(self.found), cache)
+            os.replace(tmp_file, self.cache_file)
+        return results
+
+    def _get_batch(self, batch: List[str]) -> Optional[set]:
+        """Get the accessions of a batch that are in ENA, or None if the request failed."""
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.stats_lock:
+                    self.stats["requests"] += 1
+                response = self._session().get(self.url % ",".join(batch), timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    response.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                if attempt == self.retries:
+                    return None
+                time.sleep(2 ** attempt)
+        # ENA only returns the records it has, and a 404 if it has none of them
+        if response.status_code == 404:
+            return set()
+        if not response.ok:
+            return None
+        try:
+            root = ET.fromstring(response.content)
+        except ET.ParseError:
+            return None
+        found = set()
+        for elt in root.iter():
+            if "accession" in elt.attrib:
+                found.add(elt.attrib["accession"])
+            if elt.tag in ("PRIMARY_ID", "SECONDARY_ID") and elt.text:
+                found.add(elt.text.strip())
+        return found & set(batch)
+
+
+class AbbrevRegistry:
+    """Organism abbrevs already in use, for fast lookups.
+
+    The abbrevs are also indexed by a normalized form (lowercase ascii letters and digits), to
+    suggest the abbrevs close to an unknown one.
+    """
+
+    def __init__(self, abbrevs: Iterable[str] = ()) -> None:
+        """
+        Args:
+            abbrevs: Organism abbrevs in use.
+        """
+        self.abbrevs = set()
+        self.normalized: Dict[str, List[str]] = {}
+        for abbrev in abbrevs:
+            self.add(abbrev)
+
+    @staticmethod
+    def normalize(abbrev: str) -> str:
+        return re.sub(r"[^a-z0-9]", "", unidecode(abbrev).lower())
+
+    def add(self, abbrev: str) -> None:
+        if abbrev not in self.abbrevs:
+            self.abbrevs.add(abbrev)
+            self.normalized.setdefault(self.normalize(abbrev), []).append(abbrev)
+
+    def __contains__(self, abbrev: str) -> bool:
+        return abbrev in self.abbrevs
+
+    def __len__(self) -> int:
+        return len(self.abbrevs)
+
+    def suggest(self, abbrev: str, max_suggestions: int = 3) -> List[str]:
+        """Find the abbrevs in use that are close to an abbrev.
+
+        Args:
+            abbrev: Organism abbrev (normally unknown).
+            max_suggestions: Maximum number of abbrevs to suggest.
+
+        Returns:
+            The abbrevs with the same normalized form first, then the most similar ones.
+        """
+        norm = self.normalize(abbrev)
+        suggestions = [known for known in self.normalized.get(norm, []) if known != abbrev]
+        for close in difflib.get_close_matches(norm, self.normalized, n=max_suggestions, cutoff=0.8):
+            if close != norm:
+                suggestions += self.normalized[close]
+        return suggestions[:max_suggestions]
+
+
+def load_abbrevs(path: str) -> AbbrevRegistry:
     """
     Load a list of organism abbrevs from a file. Expected to be one per line.
 
@@ -42,12 +487,13 @@ def load_abbrevs(path: str) -> List[str]:
         path: Path to the organism abbrevs file.
 
     Returns:
-        A list of all organism_abbrevs.
+        A registry of all organism_abbrevs.
 
     """
     if not path:
         print("Warning: I don't have a list of older abbrevs to compare with.")
-        return []
+        return AbbrevRegistry()
+
     abbrevs = []
     with open(path, "r") as abbr_file:
         for line in abbr_file:
@@ -59,48 +505,114 @@ def load_abbrevs(path: str) -> List[str]:
                 else:
                     raise Exception(
                         "Can't load current abbrevs from a multicolumn string")
-    return abbrevs
+    return AbbrevRegistry(abbrevs)
 
 
-def retrieve_rnaseq_datasets(redmine: Redmine, output_dir_path: str, build: int = None,
-                             abbrevs_file: str = None) -> None:
+def retrieve_datasets(redmine: Redmine, output_dir_path: str, specs: List[DatatypeSpec],
+                      build: int = None, abbrevs_file: str = None, ena: EnaAccessions = None) -> None:
     """
-    Get RNA-Seq metadata from Redmine, store them in json files.
-    Each issue/dataset is stored as one file in the output dir.
+    Get datasets metadata from Redmine for several datatypes, store them in json files.
+    The issues of all the datatypes are retrieved at once, then split by datatype.
+    Each issue/dataset is stored as one file in the output dir (in a subdir for each datatype if
+    there are several).
 
     Args:
         redmine: A connected Redmine object.
         output_dir_path: Directory where the dataset files are to be stored.
+        specs: Datatypes to retrieve.
         build: BRC build number.
         abbrevs_file: Path to a list of organism_abbrevs that are already in use.
+        ena: To check that the runs accessions exist in ENA (no check if None).
     """
 
     all_abbrevs = load_abbrevs(abbrevs_file)
 
-    issues = get_issues(redmine, "RNA-seq", build)
+    issues = get_issues(redmine, [spec.datatype for spec in specs], build)
     if not issues:
         print("No files to create")
         return
-    
+
+    # Split by the DataType field used to query the issues (it can have several values)
+    issues_by_datatype = {spec.datatype: [] for spec in specs}
+    unmatched = []
+    for issue in issues:
+        value = None
+        for cf in issue.custom_fields:
+            if cf.get("id") == datatype_field_id:
+                value = cf.get("value")
+        values = value if isinstance(value, list) else [value]
+        matched = [datatype for datatype in values if datatype in issues_by_datatype]
+        for datatype in matched:
+            issues_by_datatype[datatype].append(issue)
+        if not matched:
+            unmatched.append({"issue": issue, "desc": f"Unknown DataType: {value}"})
+    print_summaries(unmatched, "issues with problems (not imported)")
+
+    for spec in specs:
+        output_dir = Path(output_dir_path)
+        if len(specs) > 1:
+            output_dir.mkdir(exist_ok=True)
+            output_dir = output_dir / spec.name
+            print(f"\n## {spec.datatype}")
+        extract_datasets(issues_by_datatype[spec.datatype], spec, output_dir, all_abbrevs, abbrevs_file,
+                         ena)
+
+
+def extract_datasets(issues: List[RedmineIssue], spec: DatatypeSpec, output_dir: Path,
+                     all_abbrevs: AbbrevRegistry, abbrevs_file: str = None,
+                     ena: EnaAccessions = None) -> None:
+    """
+    Extract the datasets of one datatype from its Redmine issues, store them in json files.
+    Each issue/dataset is stored as one file in the output dir.
+
+    Args:
+        issues: Redmine issues of that datatype.
+        spec: Datatype of the issues.
+        output_dir: Directory where the dataset files are to be stored.
+        all_abbrevs: Registry of the organism_abbrevs that are already in use.
+        abbrevs_file: Path of the list of organism_abbrevs (only warn about new abbrevs if set).
+        ena: To check that the runs accessions exist in ENA (no check if None).
+    """
+    if not issues:
+        print(f"No {spec.datatype} files to create")
+        return
+
     # Create the output dir
-    output_dir = Path(output_dir_path)
     output_dir.mkdir(exist_ok=True)
     
     # Write all datasets in files
     all_datasets = []
-    used_names = []
+    used_names = set()
 
     problems = []
     ok_datasets = []
     warn_abbrevs = []
+    warn_ena = []
+
+    parsed = [(issue, *parse_dataset(issue, spec)) for issue in issues]
+
+    # Check all the runs accessions at once
+    in_ena = {}
+    if ena:
+        in_ena = ena.resolve(
+            acc for _, dataset, problem in parsed if not problem for acc in get_accessions(dataset)
+        )
     
-    for issue in issues:
-        dataset, problem = parse_dataset(issue)
-        
+    for issue, dataset, problem in parsed:
         if problem:
             problems.append({"issue": issue, "desc": problem})
             continue
 
+        if ena:
+            accessions = get_accessions(dataset)
+            missing = [acc for acc in accessions if in_ena[acc] is False]
+            if missing:
+                problems.append({"issue": issue, "desc": f"Not in ENA: {', '.join(missing)}"})
+                continue
+            unchecked = [acc for acc in accessions if in_ena[acc] is None]
+            if unchecked:
+                warn_ena.append({"issue": issue, "desc": ", ".join(unchecked)})
+
         try:
             component = dataset["component"]
             organism = dataset["species"]
@@ -112,10 +624,12 @@ def retrieve_rnaseq_datasets(redmine: Redmine, output_dir_path: str, build: int
                 )
                 continue
             else:
-                used_names.append(dataset_name)
+                used_names.add(dataset_name)
             
             if abbrevs_file and organism not in all_abbrevs:
-                warn_abbrevs.append({"issue": issue, "desc": organism})
+                suggestions = all_abbrevs.suggest(organism)
+                desc = f"{organism} (close to {', '.join(suggestions)}?)" if suggestions else organism
+                warn_abbrevs.append({"issue": issue, "desc": desc})
                 
             ok_datasets.append({"issue": issue, "desc": organism})
             
@@ -139,6 +653,10 @@ def retrieve_rnaseq_datasets(redmine: Redmine, output_dir_path: str, build: int
         warn_abbrevs,
         "issues using unknown organism_abbrevs (maybe new ones). Those are still imported"
     )
+    print_summaries(
+        warn_ena,
+        "issues with accessions that could not be checked in ENA. Those are still imported"
+    )
     print_summaries(ok_datasets, "datasets imported correctly")
 
     # Create a single merged file as well
@@ -169,55 +687,49 @@ def print_summaries(summaries: Dict, description: str) -> None:
             print(f"\t{desc:{desc_length}}\t{issue.id}\t({issue.subject})")
     
  
-def parse_dataset(issue: RedmineIssue) -> Tuple[Dict, str]:
+def parse_dataset(issue: RedmineIssue, spec: DatatypeSpec) -> Tuple[Dict, str]:
     """
-    Extract RNA-Seq dataset metadata from a Redmine issue.
+    Extract dataset metadata from a Redmine issue, following the fields of its datatype.
 
     Args:
         issue: A Redmine issue.
+        spec: Datatype of the issue.
 
     Returns:
         A tuple of 2 objects:
-            datasets: A dict representing a dataset, with the following keys:
+            datasets: A dict representing a dataset, with a key for each field of the datatype,
+            for instance:
                 component: String for the BRC component DB.
                 species: String for the organism abbrev.
                 name: String for the internal dataset name.
-            problem: A string description if there was a parsing problem
+                runs: List of samples dicts.
+            problem: A string description of the first parsing problem
             (empty string otherwise).
     """
     customs = get_custom_fields(issue)
-    dataset = {
-        "component": "",
-        "species": "",
-        "name": "",
-        "runs": [],
-    }
+    dataset = {}
     problem = ""
 
-    dataset["component"] = get_custom_value(customs, "Component DB")
-    dataset["species"] = get_custom_value(customs, "Organism Abbreviation").strip()
-    dataset["name"] = get_custom_value(customs, "Internal dataset name").strip()
-
-    if not dataset["species"]:
-        problem = "Missing Organism Abbreviation"
-    elif not check_organism_abbrev(dataset["species"]):
-        problem = f"Wrong Organism Abbreviation format: '{dataset['species']}'"
-    elif not dataset["name"]:
-        problem = "Missing Internal dataset name"
-    else:
-        dataset["name"] = normalize_name(dataset["name"])
-    
-    # Get samples/runs
-    samples_str = get_custom_value(customs, "Sample Names")
-    try:
-        samples = parse_samples(samples_str)
-        
-        if not samples:
-            problem = "Missing Samples"
-        
-        dataset["runs"] = samples
-    except Exception as e:
-        problem = str(e)
+    for field_spec in spec.fields:
+        value = get_custom_value(customs, field_spec.custom_field)
+        value = value.strip() if isinstance(value, str) else value
+        dataset[field_spec.key] = value
+        if problem:
+            continue
+        try:
+            if field_spec.required and not value:
+                problem = f"Missing {field_spec.label}"
+                continue
+            if field_spec.check and not field_spec.check(value):
+                problem = f"Wrong {field_spec.label} format: '{value}'"
+                continue
+            if field_spec.parse:
+                value = field_spec.parse(value)
+                dataset[field_spec.key] = value
+                if field_spec.required and not value:
+                    problem = f"Missing {field_spec.label}"
+        except Exception as e:
+            problem = str(e)
     
     return dataset, problem
 
@@ -336,6 +848,18 @@ def validate_accessions(accessions: str) -> bool:
     return True
 
 
+def get_accessions(dataset: Dict) -> List[str]:
+    """Get all the runs accessions of a dataset.
+
+    Args:
+        dataset: A dataset dict, as created by parse_dataset.
+
+    Returns:
+        The accessions of all the samples of the dataset.
+    """
+    return [acc for sample in dataset.get("runs", []) for acc in sample["accessions"]]
+
+
 def get_custom_fields(issue: RedmineIssue) -> Dict:
     """Put all Redmine custom fields in a dict instead of an array.
 
@@ -378,19 +902,19 @@ def get_custom_value(customs: Dict, key: str) -> str:
         return ""
     
 
-def get_issues(redmine: Redmine, datatype: str, build: int = None) -> List[RedmineIssue]:
+def get_issues(redmine: Redmine, datatypes: List[str], build: int = None) -> List[RedmineIssue]:
     """Retrieve all issue for new genomes, be they with or without gene sets.
 
     Args:
         redmine: A Redmine connected object.
-        datatype: What datatype to use to filter the issues.
+        datatypes: What datatypes to use to filter the issues (any of them).
         build: The BRC build to use to filter.
 
     Returns:
         A list of Redmine issues.
     """
     
-    other_fields = {"cf_94": datatype}
+    other_fields = {f"cf_{datatype_field_id}": "|".join(datatypes)}
     if build:
         version_id = get_version_id(redmine, build)
         other_fields["fixed_version_id"] = version_id
@@ -408,13 +932,15 @@ def get_version_id(redmine: Redmine, build: int) -> int:
     Returns:
         The version id from Redmine for that build.
     """
-    versions = redmine.version.filter(project_id=veupathdb_id)
+    versions = redmine.get_versions(veupathdb_id)
     version_name = "Build " + str(build)
-    version_id = [version.id for version in versions if version.name == version_name]
+    version_id = [version["id"] for version in versions if version["name"] == version_name]
+    if not version_id:
+        raise Exception(f"No Redmine version for build {build}")
     return version_id
 
    
-def get_ebi_issues(redmine, other_fields=dict()) -> RedmineResource:
+def get_ebi_issues(redmine, other_fields=dict()) -> List[RedmineIssue]:
     """Get EBI issues from Redmine, add other fields if provided.
 
     Args:
@@ -422,43 +948,90 @@ def get_ebi_issues(redmine, other_fields=dict()) -> RedmineResource:
         other_fields: A dict of fields to provide to filter the issues.
 
     Returns:
-        A Redmine resource set.
+        A list of Redmine issues.
     """
     # Other fields replace the keys that already exist in default_fields
     search_fields = {**default_fields, **other_fields}
     
-    return redmine.issue.filter(**search_fields)
+    return redmine.filter_issues(**search_fields)
     
 
+# Fields of the sequencing datasets, with their samples runs
+sequencing_fields = [
+    FieldSpec("component", "Component DB", required=False),
+    FieldSpec("species", "Organism Abbreviation", check=check_organism_abbrev),
+    FieldSpec("name", "Internal dataset name", parse=normalize_name),
+    FieldSpec("runs", "Sample Names", label="Samples", parse=parse_samples),
+]
+datatypes = {
+    "rnaseq": DatatypeSpec("rnaseq", "RNA-seq", sequencing_fields),
+    "dnaseq": DatatypeSpec("dnaseq", "DNA-seq", sequencing_fields),
+}
+
+
 def main():
     parser = argparse.ArgumentParser(description='Retrieve metadata from Redmine')
     
-    parser.add_argument('--key', type=str, required=True,
-                        help='Redmine authentification key')
+    parser.add_argument('--key', type=str,
+                        help='Redmine authentification key (required, except with --replay)')
     parser.add_argument('--output_dir', type=str, required=True,
                         help='Output_dir')
     # Choice
-    parser.add_argument('--get', choices=['rnaseq', 'dnaseq'], required=True,
-                        help='Get rnaseq, or dnaseq issues')
+    parser.add_argument('--get', choices=list(datatypes), nargs='+', required=True,
+                        help='Get rnaseq, and/or dnaseq issues (in a subdir each if several)')
     # Optional
     parser.add_argument('--build', type=int,
                         help='Restrict to a given build')
     parser.add_argument('--current_abbrevs', type=str,
                         help='File that contains the list of current organism_abbrevs')
+    parser.add_argument('--url', type=str, default=url,
+                        help=f'Redmine URL (default: {url})')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Maximum number of concurrent requests to Redmine (default: 8)')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory to cache the issues: only the issues updated since are refetched')
+    parser.add_argument('--check_ena', action='store_true',
+                        help='Check that the runs accessions exist in ENA (cached in --cache_dir)')
+    parser.add_argument('--ena_url', type=str, default=accession_api_url,
+                        help='ENA browser API URL, with %%s for the accessions (default: %(default)s)')
+    parser.add_argument('--snapshot', type=str,
+                        help='Save all the issues retrieved to this file (gzipped JSON lines), for --replay')
+    parser.add_argument('--replay', type=str,
+                        help='Use the issues of a --snapshot file instead of Redmine (no network access)')
     args = parser.parse_args()
+    if not args.key and not args.replay:
+        parser.error("--key is required to use Redmine")
+    if args.snapshot and args.replay:
+        parser.error("--snapshot can't be used with --replay")
     
-    # Start Redmine API
-    redmine = Redmine(url, key=args.key)
+    # Start Redmine API, or the snapshot to replay
+    if args.replay:
+        redmine = RedmineSnapshot(args.replay)
+    else:
+        redmine = Redmine(args.url, key=args.key, workers=args.workers, cache_dir=args.cache_dir)
     
+    ena = None
+    if args.check_ena:
+        ena_cache = Path(args.cache_dir) / "ena_accessions.json" if args.cache_dir else None
+        ena = EnaAccessions(args.ena_url, workers=args.workers, cache_file=ena_cache)
+
     # Choose which data to retrieve
-    if args.get == 'rnaseq':
-        retrieve_rnaseq_datasets(redmine, args.output_dir, args.build, args.current_abbrevs)
-    elif args.get == 'dnaseq':
-        # TODO
-        # retrieve_dnaseq_datasets(redmine, args.output_dir, args.build, args.current_abbrevs)
-        print("Not yet implemented")
+    specs = [datatypes[name] for name in dict.fromkeys(args.get)]
+    retrieve_datasets(redmine, args.output_dir, specs, args.build, args.current_abbrevs, ena)
+
+    if args.replay:
+        print(f"\nReplayed {len(redmine.issues)} issues from {args.replay}")
     else:
-        print("Need to say what data you want to --get: rnaseq? dnaseq?")
+        stats = redmine.stats
+        print(f"\n{stats['requests']} Redmine requests, {stats['fetched']} issues fetched on their own,"
+              f" {stats['cached']} from the cache")
+        if args.snapshot:
+            redmine.save_snapshot(args.snapshot)
+            print(f"Snapshot of {len(redmine.issues)} issues saved in {args.snapshot}")
+    if ena:
+        stats = ena.stats
+        print(f"{stats['requests']} ENA requests for {stats['checked']} accessions,"
+              f" {stats['cached']} from the cache")
 
 
 if __name__ == "__main__":
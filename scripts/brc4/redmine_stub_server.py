@@ -0,0 +1,310 @@
+#!env python3
+
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stub of the Redmine REST API, to test get_rnaseq_from_redmine.py without the real Redmine.
+
+The issues and versions are served from a JSON file ({"issues": [...], "versions": [...]}, with the
+issues in the Redmine JSON format). The file is reloaded when it changes, so issues can be edited
+(with a new updated_on) while the server runs. Use --generate to create a file of synthetic issues.
+
+The server also mocks the ENA browser API, for the SRA accessions of the file "ena_accessions" list
+(by default, all the accessions in the issues samples).
+
+Supported routes:
+    /issues.json: paged listing (offset, limit), filtered by cf_N, status_id and fixed_version_id
+                  (with "|" separating alternative values)
+                  (use --no_list_fields to leave the custom fields out, as Redmine can)
+    /issues/<id>.json
+    /projects/<id>/versions.json
+    /ena/browser/api/xml/<accessions>: XML of the accessions (comma separated) known to ENA
+
+Example:
+    $ python redmine_stub_server.py --issues issues.json --generate 500 --port 8080 --delay 0.05
+    $ python get_rnaseq_from_redmine.py --url http://localhost:8080 --key test --get rnaseq \\
+        --build 68 --output_dir out --cache_dir cache \\
+        --check_ena --ena_url "http://localhost:8080/ena/browser/api/xml/%s"
+"""
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import quoteattr
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+ebi_status_field = {"id": 17, "name": "EBI Status"}
+datatype_field = {"id": 94, "name": "DataType"}
+dataset_fields = [
+    {"id": 101, "name": "Component DB"},
+    {"id": 102, "name": "Organism Abbreviation"},
+    {"id": 103, "name": "Internal dataset name"},
+    {"id": 104, "name": "Sample Names"},
+]
+builds = (66, 67, 68)
+accession_pattern = r"\b[SE]R[RSXP]\d+\b"
+components = ("VectorBase", "PlasmoDB", "ToxoDB", "FungiDB")
+
+
+def generate_issues(num_issues: int, seed: int = 42) -> Dict:
+    """Create synthetic Redmine issues, with a few problems in them.
+
+    Args:
+        num_issues: Number of issues to create.
+        seed: Seed of the random generator.
+
+    Returns:
+        A dict with 3 keys: issues, versions and ena_accessions (the accessions known to ENA).
+    """
+    rng = random.Random(seed)
+    versions = [{"id": 100 + build, "name": f"Build {build}"} for build in builds]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    issues = []
+    ena_accessions = []
+    run = 1000000
+    for issue_id in range(1, num_issues + 1):
+        version = rng.choice(versions)
+        datatype = "RNA-seq" if rng.random() < 0.8 else "DNA-seq"
+        species = f"sp{rng.randrange(num_issues // 4 + 1):04d}"
+        dataset_name = f"Dataset {issue_id} (strain {rng.randrange(100)})"
+        samples = []
+        for sample in range(rng.randint(1, 6)):
+            runs = []
+            for _ in range(rng.randint(1, 3)):
+                runs.append(f"SRR{run}")
+                ena_accessions.append(f"SRR{run}")
+                run += 1
+            samples.append(f"sample_{sample}: {', '.join(runs)}")
+
+        # A few problems, as in real tickets
+        problem = rng.random()
+        if problem < 0.03:
+            species = ""
+        elif problem < 0.05:
+            samples[0] = samples[0].replace("SRR", "SRX R", 1)
+        elif problem < 0.07 and issues:
+            dataset_name = issues[-1]["custom_fields"][4]["value"]
+            species = issues[-1]["custom_fields"][3]["value"]
+        elif problem < 0.09:
+            # Typo in an accession: right format, but not in ENA
+            samples[-1] += "9"
+
+        values = [rng.choice(components), species, dataset_name, "\n".join(samples)]
+        updated_on = start + timedelta(minutes=issue_id)
+        issues.append({
+            "id": issue_id,
+            "project": {"id": 1976, "name": "VEuPathDB"},
+            "status": {"id": 5, "name": "Data Processing (EBI)"},
+            "subject": f"{datatype} data for {species or 'unknown species'}",
+            "fixed_version": {"id": version["id"], "name": version["name"]},
+            "created_on": updated_on.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "updated_on": updated_on.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "custom_fields": [
+                {**ebi_status_field, "value": "Data Processing (EBI)"},
+                {**datatype_field, "value": datatype},
+            ] + [{**cf, "value": value} for cf, value in zip(dataset_fields, values)],
+        })
+    # Redmine lists the latest issues first
+    issues.reverse()
+    return {"issues": issues, "versions": versions, "ena_accessions": ena_accessions}
+
+
+class IssueStore:
+    """Issues and versions of a JSON file, reloaded when the file changes."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.mtime = None
+        self.data = {"issues": [], "versions": []}
+        self.ena_accessions = set()
+        self.lock = threading.Lock()
+
+    def get(self) -> Dict:
+        with self.lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime:
+                with open(self.path, "r") as issues_file:
+                    self.data = json.load(issues_file)
+                if "ena_accessions" in self.data:
+                    self.ena_accessions = set(self.data["ena_accessions"])
+                else:
+                    self.ena_accessions = set()
+                    for issue in self.data["issues"]:
+                        for cf in issue.get("custom_fields", []):
+                            if isinstance(cf.get("value"), str):
+                                self.ena_accessions.update(re.findall(accession_pattern, cf["value"]))
+                self.mtime = mtime
+            return self.data
+
+
+def match_issue(issue: Dict, filters: Dict[str, List[str]]) -> bool:
+    """Check if an issue matches the Redmine filters supported by the stub (other filters are ignored).
+
+    Args:
+        issue: An issue in the Redmine JSON format.
+        filters: Query parameters, as parsed by parse_qs.
+    """
+    for name, values in filters.items():
+        values = [value for joined in values for value in joined.split("|")]
+        if "*" in values:
+            continue
+        cf_match = re.match(r"^cf_(\d+)$", name)
+        if cf_match:
+            cf_id = int(cf_match.group(1))
+            issue_values = []
+            for cf in issue.get("custom_fields", []):
+                if cf["id"] == cf_id:
+                    value = cf.get("value")
+                    issue_values = value if isinstance(value, list) else [value]
+            if not set(values) & set(map(str, issue_values)):
+                return False
+        elif name == "status_id":
+            if values != ["open"] and str(issue.get("status", {}).get("id")) not in values:
+                return False
+        elif name == "fixed_version_id":
+            if str(issue.get("fixed_version", {}).get("id")) not in values:
+                return False
+    return True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    store: IssueStore = None
+    key: str = None
+    delay: float = 0
+    no_list_fields = False
+    num_requests = 0
+    requests_lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        with self.requests_lock:
+            StubHandler.num_requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        data = self.store.get()
+
+        # The ENA API is public
+        ena_match = re.match(r"^/ena/browser/api/xml/([^/]+)$", url.path)
+        if ena_match:
+            accessions = [acc for acc in unquote(ena_match.group(1)).split(",") if acc]
+            found = [acc for acc in accessions if acc in self.store.ena_accessions]
+            self.send_ena_xml(found)
+            return
+
+        if self.key and self.headers.get("X-Redmine-API-Key") != self.key:
+            self.send_json({"errors": ["Invalid API key"]}, 401)
+            return
+
+        if url.path == "/issues.json":
+            offset = int(params.pop("offset", ["0"])[0])
+            limit = int(params.pop("limit", ["25"])[0])
+            issues = [issue for issue in data["issues"] if match_issue(issue, params)]
+            page = issues[offset:offset + limit]
+            if self.no_list_fields:
+                page = [{k: v for k, v in issue.items() if k != "custom_fields"} for issue in page]
+            self.send_json({
+                "issues": page,
+                "total_count": len(issues),
+                "offset": offset,
+                "limit": limit,
+            })
+            return
+
+        issue_match = re.match(r"^/issues/(\d+)\.json$", url.path)
+        if issue_match:
+            issue_id = int(issue_match.group(1))
+            for issue in data["issues"]:
+                if issue["id"] == issue_id:
+                    self.send_json({"issue": issue})
+                    return
+            self.send_json({"errors": ["Not found"]}, 404)
+            return
+
+        if re.match(r"^/projects/\d+/versions\.json$", url.path):
+            versions = data.get("versions", [])
+            self.send_json({"versions": versions, "total_count": len(versions)})
+            return
+
+        self.send_json({"errors": ["Not found"]}, 404)
+
+    def send_json(self, data: Dict, status: int = 200) -> None:
+        self.send_body(json.dumps(data).encode("utf-8"), "application/json", status)
+
+    def send_ena_xml(self, accessions: List[str]) -> None:
+        if not accessions:
+            self.send_body(b"Not found", "text/plain", 404)
+            return
+        runs = [
+            f"<RUN accession={quoteattr(acc)}><IDENTIFIERS><PRIMARY_ID>{acc}</PRIMARY_ID></IDENTIFIERS></RUN>"
+            for acc in accessions
+        ]
+        xml = '<?xml version="1.0" encoding="UTF-8"?>\n<RUN_SET>\n' + "\n".join(runs) + "\n</RUN_SET>\n"
+        self.send_body(xml.encode("utf-8"), "application/xml")
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        print(f"[{self.num_requests}] {format % args}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stub of the Redmine REST API, for tests')
+
+    parser.add_argument('--issues', type=str, required=True,
+                        help='JSON file with the issues and versions to serve')
+    parser.add_argument('--generate', type=int,
+                        help='Replace the issues file with this number of synthetic issues')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen to on localhost (default: 8080)')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Delay of each response in seconds, to simulate the network latency')
+    parser.add_argument('--key', type=str,
+                        help='Only accept this API key (any key is accepted by default)')
+    parser.add_argument('--no_list_fields', action='store_true',
+                        help='Leave the custom fields out of the issues listings (only in /issues/<id>.json)')
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        with open(args.issues, "w") as issues_file:
+            json.dump(generate_issues(args.generate), issues_file, indent=1)
+
+    StubHandler.store = IssueStore(args.issues)
+    StubHandler.key = args.key
+    StubHandler.delay = args.delay
+    StubHandler.no_list_fields = args.no_list_fields
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    print(f"Redmine stub serving {args.issues} on http://127.0.0.1:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
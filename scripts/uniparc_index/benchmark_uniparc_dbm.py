@@ -0,0 +1,371 @@
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput benchmark for create_uniparc_dbm.py and query_uniparc_dbm.py.
+
+Generates a synthetic UniParc-like (UPI, md5) input, then for each --config
+(a set of create_uniparc_dbm.py options):
+  * loads the input with create_uniparc_dbm.py, and measures the load rate,
+    the peak RSS (of the largest process, and of the loader and its shard
+    workers together) and the size of the index on disk;
+  * queries the index for a hit heavy and a miss heavy workload, for each
+    batch size: end to end with query_uniparc_dbm.py (process start, parsing
+    and output included), and in-process with UniParcIndex.get_multi (the
+    calls query_uniparc_dbm.py makes) to measure the batch latencies.
+
+The results are written as JSON, to compare them between releases, e.g.:
+
+    python benchmark_uniparc_dbm.py --workdir /dev/shm/bench --records 10000000 \\
+        --config hash= --config "binary=--format binary" --config "static=--static" \\
+        --report bench.json
+"""
+
+import argparse
+from datetime import datetime, UTC
+import glob
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+from uniparc_dbm import UniParcIndex, UPI_PREFIX, UPI_HEX_LEN
+
+REPORT_VERSION = 2
+CREATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_uniparc_dbm.py")
+QUERY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_uniparc_dbm.py")
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--workdir",
+        help="Directory for the generated input and indexes (e.g. in /dev/shm).",
+        required=True,
+    )
+    parser.add_argument(
+        "--records",
+        help="Number of (UPI, md5) records to generate. Default is 1M",
+        default=1_000_000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--collision_rate",
+        help="Fraction of the records reusing the md5 of a previous record. Default is 0.01",
+        default=0.01,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the random generator, for reproducible inputs. Default is 42",
+        default=42,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--config",
+        help=(
+            "Index configuration to benchmark, as 'name=create_uniparc_dbm.py options'"
+            " (e.g. 'align4=--align_pow 4'). Can be repeated. Default is 'hash='"
+        ),
+        action="append",
+        required=False,
+    )
+    parser.add_argument(
+        "--batches",
+        help="Comma separated query batch sizes. Default is 100,1000,5000,20000",
+        default="100,1000,5000,20000",
+        required=False,
+    )
+    parser.add_argument(
+        "--queries",
+        help="Number of md5s queried per workload and batch size. Default is 100k",
+        default=100_000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--report",
+        help="Write the JSON report to this file. Default is the standard output",
+        required=False,
+    )
+    parser.add_argument(
+        "--keep",
+        help="Keep the generated input, workloads, indexes and load logs in the workdir.",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    args.configs = []
+    for config in args.config or ["hash="]:
+        name, sep, options = config.partition("=")
+        if not sep or not name:
+            parser.error(f"Invalid --config '{config}', expected 'name=options'")
+        args.configs.append((name, shlex.split(options)))
+    args.batches = [int(b) for b in args.batches.split(",")]
+    return args
+
+
+def random_md5(rng):
+    return f"{rng.getrandbits(128):032X}"
+
+
+def generate_input(path, records, collision_rate, seed):
+    """Write a synthetic (UPI, md5) input file
+
+    Returns:
+        A sample of the md5s written, to be used as query hits.
+    """
+    rng = random.Random(seed)
+    sample = []
+    sample_size = 1_000_000
+    with open(path, "w") as out:
+        for i in range(records):
+            if sample and rng.random() < collision_rate:
+                md5u = rng.choice(sample)
+            else:
+                md5u = random_md5(rng)
+            # Reservoir sample of the md5s, to pick the collisions and the hits
+            if len(sample) < sample_size:
+                sample.append(md5u)
+            else:
+                j = rng.randrange(i + 1)
+                if j < sample_size:
+                    sample[j] = md5u
+            out.write(f"{UPI_PREFIX}{i:0{UPI_HEX_LEN}X}\t{md5u.lower()}\n")
+    return sample
+
+
+def workload(rng, hits, num_queries, hit_ratio):
+    """Queries mixing known md5s and random (missing) ones"""
+    return [rng.choice(hits) if rng.random() < hit_ratio else random_md5(rng) for _ in range(num_queries)]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = max(0, -(-len(values) * pct // 100) - 1)
+    return values[int(rank)]
+
+
+def index_size(dbfile):
+    """Size on disk of an index: DB file or manifest, shards and filters"""
+    return sum(os.path.getsize(path) for path in glob.glob(f"{glob.escape(dbfile)}*"))
+
+
+def process_tree(pid):
+    """Pids of a process and of all its descendants (Linux only, empty elsewhere)"""
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children") as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def tree_rss_kb(pid):
+    """Current RSS of a process and its descendants together"""
+    total = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/statm") as statm:
+                total += int(statm.read().split()[1]) * PAGE_KB
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def run_load(input_path, dbfile, options, keep=False):
+    """Load the input with create_uniparc_dbm.py, and measure it (the log is kept if it fails)"""
+    cmd = [sys.executable, CREATE_SCRIPT, "--dbfile", dbfile, "--input", input_path, *options]
+    log_path = f"{os.path.splitext(dbfile)[0]}.log"
+    peak_tree_rss = 0
+    _start = time.perf_counter()
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=log)
+        while True:
+            # The rusage of wait4 covers this child, and the shard workers it
+            # waited for (the largest of them, as with RUSAGE_CHILDREN), but
+            # only for this load. The RSS of the whole tree is sampled for the
+            # workers running together.
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            peak_tree_rss = max(peak_tree_rss, tree_rss_kb(proc.pid))
+            time.sleep(RSS_SAMPLE_SECONDS)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - _start
+    if proc.returncode != 0:
+        raise RuntimeError(f"Load failed with exit code {proc.returncode}, see {log_path}")
+    if not keep:
+        os.remove(log_path)
+    return {
+        "command": shlex.join(cmd),
+        "seconds": seconds,
+        "peak_rss_kb": rusage.ru_maxrss,
+        "peak_tree_rss_kb": peak_tree_rss or None,
+        "disk_bytes": index_size(dbfile),
+    }
+
+
+def run_cli_queries(dbfile, workload_paths, batches, num_queries):
+    """Query the index with query_uniparc_dbm.py, and measure it end to end"""
+    results = []
+    for name, path in workload_paths.items():
+        for batch in batches:
+            cmd = [sys.executable, QUERY_SCRIPT, "--dbfile", dbfile, "--batch", str(batch)]
+            _start = time.perf_counter()
+            with open(path) as queries:
+                proc = subprocess.run(cmd, stdin=queries, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            seconds = time.perf_counter() - _start
+            if proc.returncode != 0:
+                raise RuntimeError(f"Query failed with exit code {proc.returncode}: {shlex.join(cmd)}")
+            results.append(
+                {
+                    "workload": name,
+                    "batch": batch,
+                    "queries": num_queries,
+                    "found": proc.stdout.count(b"\n"),
+                    "seconds": seconds,
+                    "queries_per_s": num_queries / seconds if seconds else None,
+                }
+            )
+    return results
+
+
+def run_queries(dbfile, workloads, batches):
+    """Query the index in batches in-process, and measure the batch latencies"""
+    index = UniParcIndex(dbfile)
+    index.open()
+    results = []
+    for name, queries in workloads.items():
+        for batch in batches:
+            latencies = []
+            found = 0
+            _start = time.perf_counter()
+            for i in range(0, len(queries), batch):
+                _batch = time.perf_counter()
+                found += len(index.get_multi(queries[i : i + batch]))
+                latencies.append(time.perf_counter() - _batch)
+            seconds = time.perf_counter() - _start
+            latencies.sort()
+            results.append(
+                {
+                    "workload": name,
+                    "batch": batch,
+                    "queries": len(queries),
+                    "found": found,
+                    "seconds": seconds,
+                    "queries_per_s": len(queries) / seconds if seconds else None,
+                    "batch_p50_ms": percentile(latencies, 50) * 1000,
+                    "batch_p99_ms": percentile(latencies, 99) * 1000,
+                }
+            )
+    index.close()
+    return results
+
+
+## MAIN ##
+def main():
+    args = get_args()
+
+    _start = datetime.now(UTC)
+    os.makedirs(args.workdir, exist_ok=True)
+    input_path = os.path.join(args.workdir, "uniparc_bench.tsv")
+    print(
+        f"Generating {args.records} records in {input_path} ({_start}: {_start - _start})",
+        file=sys.stderr,
+    )
+    hits = generate_input(input_path, args.records, args.collision_rate, args.seed)
+    rng = random.Random(args.seed + 1)
+    workloads = {
+        "hit_heavy": workload(rng, hits, args.queries, 0.95),
+        "miss_heavy": workload(rng, hits, args.queries, 0.05),
+    }
+    workload_paths = {}
+    for name, queries in workloads.items():
+        workload_paths[name] = os.path.join(args.workdir, f"uniparc_bench_{name}.txt")
+        with open(workload_paths[name], "w") as out:
+            out.writelines(f"{md5u}\n" for md5u in queries)
+
+    report = {
+        "report_version": REPORT_VERSION,
+        "date": _start.isoformat(),
+        "host": {
+            "node": platform.node(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "parameters": {
+            "records": args.records,
+            "collision_rate": args.collision_rate,
+            "seed": args.seed,
+            "queries": args.queries,
+            "batches": args.batches,
+        },
+        "results": [],
+    }
+    for name, options in args.configs:
+        dbfile = os.path.join(args.workdir, f"uniparc_bench_{name}.tkh")
+        _load = datetime.now(UTC)
+        print(f"Loading config {name}: {shlex.join(options)} ({_load}: {_load - _start})", file=sys.stderr)
+        load = run_load(input_path, dbfile, options, keep=args.keep)
+        load["records_per_s"] = args.records / load["seconds"]
+
+        _query = datetime.now(UTC)
+        print(
+            f"Loaded {load['records_per_s']:.0f} records/s, querying ({_query}: {_query - _start})",
+            file=sys.stderr,
+        )
+        queries = run_queries(dbfile, workloads, args.batches)
+        cli_queries = run_cli_queries(dbfile, workload_paths, args.batches, args.queries)
+        report["results"].append(
+            {"config": name, "options": options, "load": load, "queries": queries, "cli_queries": cli_queries}
+        )
+
+        if not args.keep:
+            for path in glob.glob(f"{glob.escape(dbfile)}*"):
+                os.remove(path)
+    if not args.keep:
+        os.remove(input_path)
+        for path in workload_paths.values():
+            os.remove(path)
+
+    if args.report:
+        with open(args.report, "w") as out:
+            json.dump(report, out, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    _done = datetime.now(UTC)
+    print(f"Benchmark done ({_done}: {_done - _start})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,10 +19,43 @@
 
 import argparse
 from datetime import datetime, UTC
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue as queue_mod
+import shutil
+import stat
+import subprocess
 import sys
+import threading
 
 import tkrzw
 
+from uniparc_dbm import (
+    FORMATS,
+    FORMAT_BINARY,
+    FORMAT_TEXT,
+    META_KEY,
+    ROUTING_PREFIX_HEX,
+    UPI_BYTES,
+    Md5BloomFilter,
+    UniParcIndex,
+    decode_key,
+    decode_value,
+    encode_key,
+    encode_upis,
+    format_version,
+    join_values,
+    read_manifest,
+    read_metadata,
+    shard_index,
+    shard_path,
+    write_manifest,
+    write_metadata,
+)
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -44,9 +77,12 @@ def get_args():
     # number of keys inserted. If there are more entries, keys will hash to the
     # same bucket and be stored in a linked list. Eventually, performance will
     # deteriorate, so this should be chosen to be large enough.
-    # If a DB grows over time to exceed the initial value, it should be rebuilt.
-    # It's possible to rebuild an existing database. This is not currently part
-    # of this script.
+    # If a DB grows over time to exceed the initial value, it should be rebuilt:
+    # after loading, the DB is rebuilt if its load factor is over --max_load,
+    # and an existing DB can be rebuilt with --rebuild.
+    # By default, the number of records is estimated from the input size (when
+    # it is a file, not a pipe) and a sample of its lines, or counted with
+    # --count_input.
     # The dbsize option is only applied when creating a database. When opening
     # an existing DB, it is ignored.
     parser.add_argument(
@@ -54,31 +90,434 @@ def get_args():
         help=(
             "Tunes the number of hash buckets for the DB. This should ideally be"
             " about 20%% more than the number of entries you expect."
-            " Default is 1.2 billion."
+            " Default is estimated from the input, or 1.2 billion if that's not possible."
+        ),
+        default=None,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--input",
+        help="Input file (UPI and md5 per line). Default is the standard input.",
+        required=False,
+    )
+    parser.add_argument(
+        "--count_input",
+        help="Count the input lines (needs a file) to size the DB, instead of estimating from a sample.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max_load",
+        help="Rebuild the hash DB after loading if it has more records per bucket than this. Default is 1.0",
+        default=1.0,
+        required=False,
+        type=float,
+    )
+    # Checkpoints only apply to single file hash loads of an input (not --convert_from). The input offsets
+    # assume one byte per character (UniParc input is ASCII).
+    parser.add_argument(
+        "--checkpoint_every",
+        help=(
+            "Synchronize the DB and save a checkpoint (in DBFILE.checkpoint) every N records,"
+            " to be able to --resume the load. 0 to disable. Default is 100M"
+        ),
+        default=100_000_000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--resume",
+        help=(
+            "Resume a load interrupted after a checkpoint: keep the DB, seek the input"
+            " (or skip the lines already loaded from a pipe) and continue."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--inspect",
+        help="Report the fill ratio and expected chain lengths of an existing --dbfile, then exit.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--inspect_chains",
+        help=(
+            "With --inspect: also compute the actual chain lengths, by hashing all the keys"
+            " (slow, needs 1 byte of RAM per bucket)."
         ),
-        default=1_200_000_000,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rebuild",
+        help=(
+            "Rebuild an existing hash --dbfile with --dbsize buckets"
+            " (default: 20%% more than its records), then exit."
+        ),
+        action="store_true",
+    )
+    # With several shards, the input is split by md5 prefix and each shard is
+    # loaded by its own worker process. The file given by --dbfile is then a
+    # small JSON manifest that query_uniparc_dbm.py uses to route the keys.
+    # The shard files are created next to it (<dbfile>.shardNNN) and should be
+    # moved together with it.
+    parser.add_argument(
+        "--shards",
+        help=(
+            "Number of shard files to load in parallel (one worker process each)."
+            " The --dbsize buckets are split between the shards. Default is 1 (no sharding)."
+        ),
+        default=1,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--shard_chunk",
+        help="Number of input lines sent to a shard worker at once. Default is 10k",
+        default=10_000,
         required=False,
         type=int,
     )
 
+    # A static index is a tkrzw SkipDBM: records are stored sorted by md5, so it
+    # can be written sequentially in a single pass, without the random bucket
+    # writes (and RAM) of the HashDBM. Lookups cost O(log n) page reads.
+    # The index can't be updated afterwards, it has to be rebuilt.
+    parser.add_argument(
+        "--static",
+        help=(
+            "Build a compact, read-only index sorted by md5 (tkrzw SkipDBM) instead of a hash DB."
+            " The input is sorted with the external `sort` command, unless --presorted is used."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--presorted",
+        help="With --static: the input is already sorted by md5 (case insensitive), skip the external sort.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sort_tmpdir",
+        help="With --static: temporary directory for the external sort. Default is the `sort` default.",
+        required=False,
+    )
+    parser.add_argument(
+        "--sort_mem",
+        help="With --static: memory buffer for the external sort (`sort -S` syntax). Default is 2G",
+        default="2G",
+        required=False,
+    )
+
+    # The binary format stores the raw md5 digests as keys and the UPIs packed
+    # as integers, which roughly halves the size of the index. The format is
+    # recorded in the DB metadata, and query_uniparc_dbm.py reads both.
+    parser.add_argument(
+        "--format",
+        help="Format of the records. Default is text",
+        choices=FORMATS.keys(),
+        default="text",
+        required=False,
+    )
+    # Record offsets are stored on offset_width bytes, in units of
+    # 2^align_pow bytes: the defaults allow DB files up to 2^(5*8+3) = 8TB.
+    parser.add_argument(
+        "--offset_width",
+        help="Width in bytes of the record offsets in the DB files. Default is 5",
+        default=5,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--align_pow",
+        help="Alignment of the hash DB records, as a power of 2. Default is 3",
+        default=3,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--convert_from",
+        help=(
+            "Read the records from this existing index instead of the standard input,"
+            " e.g. to convert a text index to the binary format."
+        ),
+        required=False,
+    )
+
+    # The Bloom filter is stored next to each DB file (<file>.filter) and loaded
+    # by query_uniparc_dbm.py, which then answers most misses without probing
+    # the DB. It is sized with the number of buckets, so --dbsize should be
+    # set correctly.
+    parser.add_argument(
+        "--filter",
+        help="Also create a Bloom filter of the md5s, to speed up queries that are mostly misses.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--filter_bits",
+        help="Number of filter bits per md5 (about 2%% false positives with 8). Default is 8",
+        default=8,
+        required=False,
+        type=int,
+    )
+
+    # Delta mode: instead of loading the whole release, copy the index of the
+    # previous release and only apply the changes. The release of each index
+    # is stored in its metadata, so that a delta is never applied to the wrong
+    # base. Only single file hash indexes can be updated.
+    parser.add_argument(
+        "--release",
+        help="UniParc release of the input, recorded in the DB metadata. Required in delta mode.",
+        required=False,
+    )
+    parser.add_argument(
+        "--base_dbfile",
+        help="Delta mode: existing index of the previous release, copied to --dbfile then updated.",
+        required=False,
+    )
+    parser.add_argument(
+        "--base_release",
+        help="Delta mode: release expected in the --base_dbfile metadata.",
+        required=False,
+    )
+    parser.add_argument(
+        "--delta",
+        help=(
+            "Delta mode: file of changes to apply, one per line:"
+            " '+' (added) or '-' (removed), UPI and md5, separated by white spaces."
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        "--previous_input",
+        help=(
+            "Delta mode: input file of the previous release. The changes are computed"
+            " by comparing it to the new input (read from the standard input), both sorted externally."
+        ),
+        required=False,
+    )
+
     args = parser.parse_args()
+    args.format_version = FORMATS[args.format]
+    if args.delta or args.previous_input:
+        if bool(args.delta) == bool(args.previous_input):
+            parser.error("Delta mode needs either --delta or --previous_input")
+        if not (args.base_dbfile and args.base_release and args.release):
+            parser.error("Delta mode needs --base_dbfile, --base_release and --release")
+        if args.shards > 1 or args.static or args.convert_from:
+            parser.error("Delta mode can't be combined with --shards, --static or --convert_from")
+        if os.path.abspath(args.base_dbfile) == os.path.abspath(args.dbfile):
+            parser.error("--base_dbfile and --dbfile must be different files")
+    if args.convert_from and os.path.abspath(args.convert_from) == os.path.abspath(args.dbfile):
+        parser.error("--convert_from and --dbfile must be different files")
+    if args.presorted and not args.static:
+        parser.error("--presorted can only be used with --static")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.inspect and args.rebuild:
+        parser.error("--inspect and --rebuild can't be used together")
+    if args.inspect_chains and not args.inspect:
+        parser.error("--inspect_chains can only be used with --inspect")
+    if args.count_input and args.convert_from:
+        parser.error("--count_input can't be used with --convert_from")
+    if args.input and args.convert_from:
+        parser.error("--input can't be used with --convert_from")
+    if args.resume and (args.shards > 1 or args.static or args.convert_from or args.base_dbfile):
+        parser.error("--resume can only be used for single file hash loads")
     return args
 
 
-def add_uniparc_data(db, stream, _start):
+def index_metadata(args):
+    metadata = {"format_version": args.format_version}
+    if args.release:
+        metadata["release"] = args.release
+    return metadata
+
+
+def open_db(dbfile, num_buckets, metadata, offset_width=5, align_pow=3, truncate=True):
+    db = tkrzw.DBM()
+    # This is a Tkrzw file hash DB. Open as writeable.
+    # The DB supports compression. This is not enabled because it saves a few
+    # percent disk space but is almost half as fast
+    # see https://dbmx.net/tkrzw/api-python/tkrzw.html
+    db.Open(
+        dbfile,
+        True,  # writable
+        dbm="HashDBM",
+        no_wait=True,
+        truncate=truncate,
+        sync_hard=True,
+        offset_width=offset_width,
+        align_pow=align_pow,
+        update_mode="UPDATE_IN_PLACE",
+        num_buckets=num_buckets,
+    ).OrDie()
+    write_metadata(db, metadata)
+    return db
+
+
+def open_static_db(dbfile, metadata, offset_width=5):
+    db = tkrzw.DBM()
+    # This is a Tkrzw file skip list DB, written in md5 order.
+    # insert_in_order: records are appended as they come, so the input has to
+    # be sorted, with each key only set once.
+    db.Open(
+        dbfile,
+        True,  # writable
+        dbm="SkipDBM",
+        no_wait=True,
+        truncate=True,
+        offset_width=offset_width,
+        step_unit=4,
+        max_level=14,
+        insert_in_order=True,
+    ).OrDie()
+    # The metadata key is sorted before all the md5s
+    write_metadata(db, metadata)
+    return db
+
+
+def sort_input(stream, args, by_upi=False):
+    """Sort the input lines by md5 (2nd column, case insensitive) with the external `sort` command
+
+    Collisions keep their input order (stable sort), unless by_upi is set to
+    sort them by UPI.
+
+    Returns:
+        The `sort` process, its stdout yields the sorted lines.
+    """
+    keys = ["-k2,2", "-k1,1"] if by_upi else ["-k2,2"]
+    cmd = ["sort", "--stable", "--ignore-case", "--ignore-leading-blanks", *keys, "-S", args.sort_mem]
+    if args.sort_tmpdir:
+        cmd += ["-T", args.sort_tmpdir]
+    env = {**os.environ, "LC_ALL": "C"}
+    if hasattr(stream, "fileno"):
+        return subprocess.Popen(cmd, stdin=stream, stdout=subprocess.PIPE, env=env, text=True)
+
+    # Not a file: feed the lines from a thread
+    sorter = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True)
+
+    def feed():
+        with sorter.stdin:
+            sorter.stdin.writelines(stream)
+
+    threading.Thread(target=feed, daemon=True).start()
+    return sorter
+
+
+def iter_index_lines(dbfile):
+    """Yield the records of an existing index as input lines (one per UPI)"""
+    index = UniParcIndex(dbfile)
+    index.open()
+    for md5u, upis in index.iter_records():
+        md5u = md5u.decode("utf-8")
+        for uniparc_id in upis.decode("utf-8").split("\t"):
+            yield f"{uniparc_id}\t{md5u}\n"
+    index.close()
+
+
+class LoadCheckpoint:
+    """Sidecar file recording how far a load went, to resume it"""
+
+    def __init__(self, dbfile, every, dbsize, fmt_version):
+        self.path = f"{dbfile}.checkpoint"
+        self.every = every
+        self.state = {
+            "records": 0,
+            "offset": 0,
+            "collisions": 0,
+            "last_line": "",
+            "dbsize": dbsize,
+            "format_version": fmt_version,
+        }
+        self.resumed = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"No checkpoint to resume from: {self.path}")
+        with open(self.path, "r") as checkpoint_file:
+            self.state = json.load(checkpoint_file)
+        self.resumed = True
+
+    def save(self, db, records, offset, collisions, last_line, _start):
+        """Flush the DB, then record the position of the input"""
+        db.Synchronize(False).OrDie()
+        self.state.update(records=records, offset=offset, collisions=collisions, last_line=last_line)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(self.state, checkpoint_file)
+        os.replace(tmp_path, self.path)
+        _saved = datetime.now(UTC)
+        print(f"Checkpoint at record {records} ({_saved}: {_saved - _start})", file=sys.stderr)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def seek_input(self, stream):
+        """Position the input after the last checkpointed record
+
+        Returns:
+            The offset of the input.
+        """
+        last_line = self.state["last_line"]
+        fd = stream.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            if not self.resumed:
+                return os.lseek(fd, 0, os.SEEK_CUR)
+            offset = self.state["offset"]
+            seen = os.pread(fd, len(last_line), offset - len(last_line)).decode("utf-8")
+            os.lseek(fd, offset, os.SEEK_SET)
+        else:
+            if not self.resumed:
+                return 0
+            seen = ""
+            for seen in itertools.islice(stream, self.state["records"]):
+                pass
+        if seen != last_line:
+            raise ValueError(
+                f"The input doesn't match the checkpoint: expected '{last_line.strip()}'"
+                f" at record {self.state['records']}, got '{seen.strip()}'"
+            )
+        return self.state["offset"]
+
+
+def has_upi(prev, value, fmt_version):
+    """Check if an encoded UPI is already in a DB value"""
+    if fmt_version == FORMAT_BINARY:
+        return any(prev[i : i + UPI_BYTES] == value for i in range(0, len(prev), UPI_BYTES))
+    return value in prev.split(b"\t")
+
+
+def refill_filter(db, bloom, fmt_version):
+    """Add the md5s already in a DB to a new Bloom filter"""
+    for key, _ in db:
+        if key != META_KEY:
+            bloom.add(decode_key(key, fmt_version))
+
+
+def add_uniparc_data(db, stream, _start, fmt_version=FORMAT_TEXT, bloom=None, checkpoint=None):
     _batch_start = datetime.now(UTC)
-    cnt, collisions = 0, 0
-    for cnt, line in enumerate(stream, start=1):
+    cnt, collisions, offset, line = 0, 0, 0, ""
+    if checkpoint:
+        offset = checkpoint.seek_input(stream)
+        cnt, collisions = checkpoint.state["records"], checkpoint.state["collisions"]
+    for cnt, line in enumerate(stream, start=cnt + 1):
         uniparc_id, md5u = line.strip().split()  # NB: split on WS
         md5u = md5u.upper().encode("utf-8")
-        status, prev = db.SetAndGet(md5u, uniparc_id.encode("utf-8"), True)  # overwrite: True
-        if prev:
+        key = encode_key(md5u, fmt_version)
+        value = encode_upis([uniparc_id], fmt_version)
+        status, prev = db.SetAndGet(key, value, True)  # overwrite: True
+        if bloom is not None and not prev:
+            bloom.add(md5u)
+        if prev and checkpoint and checkpoint.resumed and has_upi(prev, value, fmt_version):
+            # Already loaded after the last checkpoint
+            db.Set(key, prev, True)  # overwrite: True
+        elif prev:
             collisions += 1
-            extended = "\t".join([prev.decode("utf-8"), uniparc_id]).encode("utf-8")
-            db.Set(md5u, extended, True)  # overwrite: True
+            extended = join_values(prev, value, fmt_version)
+            db.Set(key, extended, True)  # overwrite: True
             _collision = datetime.now(UTC)
             print(
-                f"Collision for '{md5u} : { extended }' ({_collision}: {_collision - _start})",
+                f"Collision for '{md5u} : { decode_value(extended, fmt_version) }'"
+                f" ({_collision}: {_collision - _start})",
                 file=sys.stderr,
             )
         if cnt % 100_000_000 == 0:
@@ -86,40 +525,616 @@ def add_uniparc_data(db, stream, _start):
             print(
                 f"Loaded {cnt} records ({collisions} collisions) ({_info}: {_info - _start})", file=sys.stderr
             )
+        if checkpoint:
+            offset += len(line)
+            if checkpoint.every and cnt % checkpoint.every == 0:
+                checkpoint.save(db, cnt, offset, collisions, line, _start)
     return cnt, collisions
 
 
-## MAIN ##
-def main():
-    args = get_args()
+def add_sorted_uniparc_data(db, stream, _start, fmt_version=FORMAT_TEXT, bloom=None):
+    """Load input sorted by md5: all the UPIs of a md5 are grouped before a single write"""
+    cnt, collisions = 0, 0
+    prev_md5u, upis = None, []
 
-    _start = datetime.now(UTC)
+    def store(md5u, upis):
+        if bloom is not None:
+            bloom.add(md5u)
+        key = encode_key(md5u, fmt_version)
+        db.Set(key, encode_upis(upis, fmt_version), False).OrDie()  # overwrite: False
+        if len(upis) > 1:
+            _collision = datetime.now(UTC)
+            print(
+                f"Collision for '{md5u} : { upis }' ({_collision}: {_collision - _start})",
+                file=sys.stderr,
+            )
+
+    for cnt, line in enumerate(stream, start=1):
+        uniparc_id, md5u = line.strip().split()  # NB: split on WS
+        md5u = md5u.upper().encode("utf-8")
+        if md5u == prev_md5u:
+            collisions += 1
+            upis.append(uniparc_id)
+        else:
+            if prev_md5u is not None:
+                if md5u < prev_md5u:
+                    raise ValueError(f"Input is not sorted by md5 at line {cnt}: {md5u} after {prev_md5u}")
+                store(prev_md5u, upis)
+            prev_md5u, upis = md5u, [uniparc_id]
+        if cnt % 100_000_000 == 0:
+            _info = datetime.now(UTC)
+            print(
+                f"Loaded {cnt} records ({collisions} collisions) ({_info}: {_info - _start})", file=sys.stderr
+            )
+    if prev_md5u is not None:
+        store(prev_md5u, upis)
+    return cnt, collisions
+
+
+def load_file(dbfile, args, stream, _start):
+    """Create one DB file and load the stream in it"""
+    num_buckets = -(-args.dbsize // args.shards)
+    bloom = new_filter(args, num_buckets)
+    if args.static:
+        db = open_static_db(dbfile, index_metadata(args), args.offset_width)
+        loaded_cnt, collisions = add_sorted_uniparc_data(db, stream, _start, args.format_version, bloom)
+    else:
+        db = open_db(dbfile, num_buckets, index_metadata(args), args.offset_width, args.align_pow)
+        loaded_cnt, collisions = add_uniparc_data(db, stream, _start, args.format_version, bloom)
+        check_load_factor(db, dbfile, num_buckets, args.max_load, _start)
+    db.Close().OrDie()
+    save_filter(bloom, dbfile, _start)
+    return loaded_cnt, collisions
+
+
+BUCKETS_PER_RECORD = 1.2
+SAMPLE_BYTES = 4 * 1024 * 1024
+
+
+def input_fd(args):
+    """File descriptor of the input, if it's a regular file (None for pipes)"""
+    if args.input:
+        return os.open(args.input, os.O_RDONLY)
+    fd = sys.stdin.fileno()
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        return fd
+    return None
+
+
+def estimate_records(args):
+    """Estimate the number of input records without consuming the input
+
+    Returns:
+        The number of records, or None if the input is not a regular file.
+    """
+    if args.convert_from:
+        index = UniParcIndex(args.convert_from)
+        index.open()
+        # Minus the metadata records; collisions are counted once
+        records = sum(db.Count() for db in index.dbs) - len(index.dbs)
+        index.close()
+        return records
+
+    fd = input_fd(args)
+    if fd is None:
+        return None
+    try:
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+        size = os.fstat(fd).st_size - start
+        if args.count_input:
+            # wc -l
+            records, offset = 0, start
+            while True:
+                chunk = os.pread(fd, 64 * SAMPLE_BYTES, offset)
+                if not chunk:
+                    break
+                records += chunk.count(b"\n")
+                offset += len(chunk)
+            return records
+        sample = os.pread(fd, SAMPLE_BYTES, start)
+        lines = sample.count(b"\n")
+        if not lines:
+            return 1 if size else 0
+        return math.ceil(size / (len(sample[: sample.rindex(b"\n") + 1]) / lines))
+    finally:
+        if args.input:
+            os.close(fd)
+
+
+def resolve_dbsize(args, _start):
+    """Number of buckets to use: --dbsize, or 20% more than the estimated number of records"""
+    if args.dbsize:
+        return args.dbsize
+    records = estimate_records(args)
+    _estimated = datetime.now(UTC)
+    if records is None and args.count_input:
+        raise ValueError("--count_input needs a regular input file, not a pipe: use --dbsize instead")
+    if records is None:
+        print(
+            f"Can't estimate the number of records from a pipe: using the default 1.2 billion buckets"
+            f" ({_estimated}: {_estimated - _start})",
+            file=sys.stderr,
+        )
+        return 1_200_000_000
+    dbsize = max(1, math.ceil(records * BUCKETS_PER_RECORD))
     print(
-        f"Opening DB {args.dbfile} with {args.dbsize} buckets ({_start}: {_start - _start})", file=sys.stderr
+        f"Estimated {records} records: using {dbsize} buckets ({_estimated}: {_estimated - _start})",
+        file=sys.stderr,
     )
+    return dbsize
+
+
+def check_load_factor(db, dbfile, num_buckets, max_load, _start):
+    """Rebuild a hash DB with more buckets if it holds too many records per bucket"""
+    records = db.Count()
+    load = records / num_buckets
+    if load <= max_load:
+        return
+    new_buckets = math.ceil(records * BUCKETS_PER_RECORD)
+    _rebuild = datetime.now(UTC)
+    print(
+        f"{dbfile}: load factor {load:.2f} is over {max_load}, rebuilding with {new_buckets} buckets"
+        f" ({_rebuild}: {_rebuild - _start})",
+        file=sys.stderr,
+    )
+    db.Rebuild(num_buckets=new_buckets).OrDie()
+    _rebuilt = datetime.now(UTC)
+    print(f"{dbfile}: rebuilt ({_rebuilt}: {_rebuilt - _start})", file=sys.stderr)
+
+
+def index_files(dbfile):
+    """DB class and files of an index (single file or manifest)"""
+    manifest = read_manifest(dbfile)
+    if manifest:
+        return manifest.get("dbm", "HashDBM"), manifest["shards"]
+    return "HashDBM", [dbfile]
+
+
+def chain_lengths(db, num_buckets):
+    """Histogram of the chain lengths of a hash DB, hashing all the keys as tkrzw does"""
+    counts = bytearray(num_buckets)
+    for key, _ in db:
+        bucket = tkrzw.Utility.PrimaryHash(key, num_buckets)
+        if counts[bucket] < 255:
+            counts[bucket] += 1
+    histogram = {}
+    for length, buckets in enumerate(counts.count(i) for i in range(256)):
+        if buckets:
+            histogram[length] = buckets
+    return histogram
+
+
+def inspect_index(args):
+    """Report the fill ratio and chain lengths of each DB file of an index"""
+    dbm, paths = index_files(args.dbfile)
+    for path in paths:
+        db = tkrzw.DBM()
+        db.Open(path, False, dbm=dbm, no_wait=True).OrDie()
+        info = db.Inspect()
+        records = int(info.get("num_records", db.Count()))
+        print(f"{path}\tclass\t{info.get('class', dbm)}")
+        print(f"{path}\trecords\t{records}")
+        print(f"{path}\tfile_size\t{os.path.getsize(path)}")
+        print(f"{path}\tmetadata\t{read_metadata(db)}")
+        if dbm == "HashDBM" and "num_buckets" in info:
+            num_buckets = int(info["num_buckets"])
+            load = records / num_buckets
+            print(f"{path}\tbuckets\t{num_buckets}")
+            print(f"{path}\tload_factor\t{load:.4f}")
+            # With uniformly hashed keys, the chain lengths follow a Poisson law
+            print(f"{path}\texpected_empty_buckets\t{math.exp(-load):.4f}")
+            if load > 0:
+                print(f"{path}\texpected_mean_chain\t{load / (1 - math.exp(-load)):.4f}")
+            print(f"{path}\tshould_be_rebuilt\t{load > args.max_load}")
+            if args.inspect_chains:
+                for length, buckets in chain_lengths(db, num_buckets).items():
+                    label = f"{length}+" if length == 255 else str(length)
+                    print(f"{path}\tchain_length_{label}\t{buckets}")
+        db.Close().OrDie()
+
+
+def rebuild_index(args, _start):
+    """Rebuild the hash DB files of an index, with --dbsize buckets or 20% more than their records"""
+    dbm, paths = index_files(args.dbfile)
+    if dbm != "HashDBM":
+        raise ValueError(f"Only hash DBs can be rebuilt, {args.dbfile} is a {dbm}")
+    for path in paths:
+        db = tkrzw.DBM()
+        db.Open(path, True, dbm=dbm, no_wait=True, sync_hard=True).OrDie()
+        records = db.Count()
+        if args.dbsize:
+            num_buckets = -(-args.dbsize // len(paths))
+        else:
+            num_buckets = math.ceil(records * BUCKETS_PER_RECORD)
+        _rebuild = datetime.now(UTC)
+        print(
+            f"Rebuilding {path} ({records} records) with {num_buckets} buckets"
+            f" ({_rebuild}: {_rebuild - _start})",
+            file=sys.stderr,
+        )
+        db.Rebuild(num_buckets=num_buckets).OrDie()
+        db.Close().OrDie()
+    _rebuilt = datetime.now(UTC)
+    print(f"Rebuild OK ({_rebuilt}: {_rebuilt - _start})", file=sys.stderr)
+
+
+def new_filter(args, num_buckets):
+    if not args.filter:
+        return None
+    # Buckets are ~20% more than the expected records
+    return Md5BloomFilter.for_keys(num_buckets, args.filter_bits)
+
+
+def save_filter(bloom, dbfile, _start):
+    if bloom is None:
+        return
+    path = Md5BloomFilter.path(dbfile)
+    bloom.save(path)
+    _saved = datetime.now(UTC)
+    print(
+        f"Filter of {bloom.num_keys} md5s ({bloom.num_bits // 8} bytes) saved to {path}"
+        f" ({_saved}: {_saved - _start})",
+        file=sys.stderr,
+    )
+
+
+def iter_chunks(queue):
+    """Yield the lines of the chunks received from the dispatcher, until the end marker (None)"""
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            return
+        yield from chunk
+
+
+def load_shard(dbfile, args, queue, results, _start):
+    """Worker process: load the lines routed to one shard"""
+    loaded_cnt, collisions = load_file(dbfile, args, iter_chunks(queue), _start)
+    _closed = datetime.now(UTC)
+    print(
+        f"Shard {dbfile}: loaded {loaded_cnt} records ({collisions} collisions)"
+        f" ({_closed}: {_closed - _start})",
+        file=sys.stderr,
+    )
+    results.put((dbfile, loaded_cnt, collisions))
+
+
+def check_workers(workers):
+    for worker in workers:
+        if worker.exitcode not in (None, 0):
+            raise RuntimeError(f"Shard worker {worker.name} failed with exit code {worker.exitcode}")
+
+
+def put_chunk(queue, chunk, workers):
+    """Send a chunk to a shard worker, without blocking forever if a worker died"""
+    while True:
+        try:
+            queue.put(chunk, timeout=10)
+            return
+        except queue_mod.Full:
+            check_workers(workers)
+
+
+def load_sharded(args, stream, _start):
+    """Split the input by md5 prefix and load all the shards concurrently
+
+    Each shard covers a contiguous md5 range, so a sorted input stays sorted
+    within each shard.
+    """
+    num_shards = args.shards
+    paths = [shard_path(args.dbfile, idx) for idx in range(num_shards)]
+
+    # Bounded queues, so that a slow shard slows down the dispatcher instead of
+    # piling up the whole input in memory
+    queues = [multiprocessing.Queue(maxsize=16) for _ in paths]
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=load_shard, args=(path, args, queue, results, _start))
+        for path, queue in zip(paths, queues)
+    ]
+    for worker in workers:
+        worker.start()
+
+    buffers = [[] for _ in paths]
+    cnt = 0
+    for cnt, line in enumerate(stream, start=1):
+        _, md5u = line.split()  # NB: split on WS
+        idx = shard_index(md5u, num_shards)
+        buffers[idx].append(line)
+        if len(buffers[idx]) >= args.shard_chunk:
+            put_chunk(queues[idx], buffers[idx], workers)
+            buffers[idx] = []
+        if cnt % 100_000_000 == 0:
+            _info = datetime.now(UTC)
+            print(f"Dispatched {cnt} records ({_info}: {_info - _start})", file=sys.stderr)
+
+    for buffer, queue in zip(buffers, queues):
+        if buffer:
+            put_chunk(queue, buffer, workers)
+        put_chunk(queue, None, workers)
+
+    loaded = {}
+    while len(loaded) < len(workers):
+        try:
+            path, loaded_cnt, collisions = results.get(timeout=10)
+            loaded[path] = (loaded_cnt, collisions)
+        except queue_mod.Empty:
+            check_workers(workers)
+    for worker in workers:
+        worker.join()
+    check_workers(workers)
+
+    loaded_cnt = sum(loaded_cnt for loaded_cnt, _ in loaded.values())
+    collisions = sum(collisions for _, collisions in loaded.values())
+    if loaded_cnt != cnt:
+        raise RuntimeError(f"Dispatched {cnt} records, but the shards only loaded {loaded_cnt}")
+
+    return loaded_cnt, collisions, paths, [loaded[path][0] for path in paths]
+
+
+def write_index_manifest(args, paths, records):
+    write_manifest(
+        args.dbfile,
+        {
+            **index_metadata(args),
+            "dbm": "SkipDBM" if args.static else "HashDBM",
+            "routing_prefix_hex": ROUTING_PREFIX_HEX,
+            "shards": paths,
+            "records": records,
+        },
+    )
+
+
+def load_indexed(args, stream, _start):
+    """Load a sharded and/or static index, described by a manifest written to --dbfile"""
+    index_type = "static (SkipDBM)" if args.static else f"hash (HashDBM, {args.dbsize} buckets in total)"
+    print(
+        f"Loading {args.shards} shard(s) of {args.dbfile}, {index_type} ({_start}: {_start - _start})",
+        file=sys.stderr,
+    )
+    sorter = None
+    if args.static and not args.presorted:
+        print(f"Sorting the input by md5 ({_start}: {_start - _start})", file=sys.stderr)
+        sorter = sort_input(stream, args)
+        stream = sorter.stdout
+
+    if args.shards > 1:
+        loaded_cnt, collisions, paths, records = load_sharded(args, stream, _start)
+    else:
+        paths = [shard_path(args.dbfile, 0)]
+        loaded_cnt, collisions = load_file(paths[0], args, stream, _start)
+        records = [loaded_cnt]
+
+    if sorter and sorter.wait() != 0:
+        raise RuntimeError(f"External sort failed with exit code {sorter.returncode}")
+    write_index_manifest(args, paths, records)
+
+    _loaded = datetime.now(UTC)
+    print(
+        f"Loaded {loaded_cnt} records ({collisions} collisions). Manifest written to {args.dbfile}"
+        f" ({_loaded}: {_loaded - _start})",
+        file=sys.stderr,
+    )
+
+
+def iter_delta(stream):
+    """Parse a delta file
+
+    Yields:
+        Tuples of change ('+' or '-'), UPI, upper case md5 (as bytes).
+    """
+    for cnt, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        change, uniparc_id, md5u = line.split()  # NB: split on WS
+        if change not in ("+", "-"):
+            raise ValueError(f"Unknown change '{change}' at line {cnt} of the delta")
+        yield change, uniparc_id, md5u.upper().encode("utf-8")
+
+
+def diff_inputs(previous, current):
+    """Compare two inputs sorted by md5, then UPI
+
+    Yields:
+        The changes from the previous input to the current one, as iter_delta.
+    """
+
+    def records(stream, name):
+        prev = None
+        for line in stream:
+            uniparc_id, md5u = line.split()  # NB: split on WS
+            record = (md5u.upper().encode("utf-8"), uniparc_id)
+            if prev is not None and record < prev:
+                raise ValueError(f"The {name} input is not sorted: {record} after {prev}")
+            prev = record
+            yield record
+
+    old_records, new_records = records(previous, "previous"), records(current, "current")
+    old, new = next(old_records, None), next(new_records, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old < new):
+            yield "-", old[1], old[0]
+            old = next(old_records, None)
+        elif old is None or new < old:
+            yield "+", new[1], new[0]
+            new = next(new_records, None)
+        else:
+            old, new = next(old_records, None), next(new_records, None)
+
+
+def apply_delta(db, changes, _start, fmt_version=FORMAT_TEXT, bloom=None):
+    """Apply changes to the collision lists of the md5s
+
+    Returns:
+        Number of UPIs inserted, removed, and of changes that didn't apply
+        (added UPI already there, or removed UPI missing).
+    """
+    inserted, removed, skipped = 0, 0, 0
+    for cnt, (change, uniparc_id, md5u) in enumerate(changes, start=1):
+        key = encode_key(md5u, fmt_version)
+        prev = db.Get(key)
+        upis = decode_value(prev, fmt_version).decode("utf-8").split("\t") if prev else []
+        if change == "+":
+            if uniparc_id in upis:
+                skipped += 1
+                continue
+            upis.append(uniparc_id)
+            inserted += 1
+        else:
+            if uniparc_id not in upis:
+                skipped += 1
+                _skipped = datetime.now(UTC)
+                print(
+                    f"Can't remove missing '{md5u} : {uniparc_id}' ({_skipped}: {_skipped - _start})",
+                    file=sys.stderr,
+                )
+                continue
+            upis.remove(uniparc_id)
+            removed += 1
+
+        if upis:
+            db.Set(key, encode_upis(upis, fmt_version), True).OrDie()  # overwrite: True
+            if bloom is not None and not prev:
+                bloom.add(md5u)
+        else:
+            db.Remove(key).OrDie()
+        if cnt % 10_000_000 == 0:
+            _info = datetime.now(UTC)
+            print(
+                f"Applied {cnt} changes ({inserted} inserted, {removed} removed, {skipped} skipped)"
+                f" ({_info}: {_info - _start})",
+                file=sys.stderr,
+            )
+    return inserted, removed, skipped
+
+
+def update_from_delta(args, stream, _start):
+    """Delta mode: copy the base index to --dbfile and apply the changes to it"""
+    if read_manifest(args.base_dbfile):
+        raise ValueError(f"Only single file hash indexes can be updated, {args.base_dbfile} is not one")
+
+    # Check the base before copying it
+    base = tkrzw.DBM()
+    base.Open(args.base_dbfile, False, dbm="HashDBM", no_wait=True).OrDie()
+    metadata = read_metadata(base)
+    base.Close().OrDie()
+    base_release = metadata.get("release")
+    if base_release != args.base_release:
+        raise ValueError(
+            f"{args.base_dbfile} is from release {base_release}, not {args.base_release}:"
+            " refusing to apply the delta"
+        )
+    fmt = format_version(metadata)
+
+    print(
+        f"Copying {args.base_dbfile} (release {base_release}) to {args.dbfile} ({_start}: {_start - _start})",
+        file=sys.stderr,
+    )
+    shutil.copyfile(args.base_dbfile, args.dbfile)
+    bloom = None
+    base_filter = Md5BloomFilter.path(args.base_dbfile)
+    if os.path.exists(base_filter):
+        # Removed md5s can't be taken out of the filter: they only add false positives
+        bloom = Md5BloomFilter.load(base_filter, writable=True)
+
     db = tkrzw.DBM()
-    # This is a Tkrzw file hash DB. Open as writeable.
-    # The DB supports compression. This is not enabled because it saves a few
-    # percent disk space but is almost half as fast
-    # see https://dbmx.net/tkrzw/api-python/tkrzw.html
     db.Open(
         args.dbfile,
         True,  # writable
         dbm="HashDBM",
         no_wait=True,
-        truncate=True,
         sync_hard=True,
-        offset_width=5,  # 2^(2^5) = 2^32 ~ 4.29e9 ?
-        align_pow=3,
         update_mode="UPDATE_IN_PLACE",
-        num_buckets=args.dbsize,
     ).OrDie()
 
     _opened = datetime.now(UTC)
-    print(f"DB open OK. Loading ({_opened}: {_opened - _start})", file=sys.stderr)
+    print(f"DB open OK. Applying changes ({_opened}: {_opened - _start})", file=sys.stderr)
+    if args.delta:
+        with open(args.delta, "r") as delta_file:
+            inserted, removed, skipped = apply_delta(db, iter_delta(delta_file), _start, fmt, bloom)
+    else:
+        with open(args.previous_input, "r") as previous:
+            sorters = [sort_input(previous, args, by_upi=True), sort_input(stream, args, by_upi=True)]
+        changes = diff_inputs(sorters[0].stdout, sorters[1].stdout)
+        inserted, removed, skipped = apply_delta(db, changes, _start, fmt, bloom)
+        for sorter in sorters:
+            if sorter.wait() != 0:
+                raise RuntimeError(f"External sort failed with exit code {sorter.returncode}")
+
+    write_metadata(db, {**metadata, "release": args.release, "base_release": base_release})
+    check_load_factor(db, args.dbfile, int(db.Inspect()["num_buckets"]), args.max_load, _start)
+    _applied = datetime.now(UTC)
+    print(
+        f"Applied changes: {inserted} UPIs inserted, {removed} removed, {skipped} skipped."
+        f" Closing DB ({_applied}: {_applied - _start})",
+        file=sys.stderr,
+    )
+    db.Close().OrDie()
+    save_filter(bloom, args.dbfile, _start)
+    _closed = datetime.now(UTC)
+    print(f"DB close OK ({_closed}: {_closed - _start})", file=sys.stderr)
+
+
+def load(args, stream, _start):
+    """Load the input stream in --dbfile (or apply it as a delta, or convert --convert_from)"""
+    if args.base_dbfile:
+        update_from_delta(args, stream, _start)
+        return
+
+    if not args.resume:
+        args.dbsize = resolve_dbsize(args, _start)
+    if args.convert_from:
+        print(f"Reading the records from {args.convert_from} ({_start}: {_start - _start})", file=sys.stderr)
+        stream = iter_index_lines(args.convert_from)
+
+    if args.shards > 1 or args.static:
+        load_indexed(args, stream, _start)
+        return
+
+    checkpoint = None
+    # A conversion reads another index, not an input file: it can't be resumed
+    if (args.checkpoint_every or args.resume) and not args.convert_from:
+        checkpoint = LoadCheckpoint(args.dbfile, args.checkpoint_every, args.dbsize, args.format_version)
+        if args.resume:
+            checkpoint.load()
+            if checkpoint.state["format_version"] != args.format_version:
+                raise ValueError(f"Can't resume a load of {args.dbfile} in a different format")
+            # The DB already exists
+            args.dbsize = checkpoint.state["dbsize"]
+            checkpoint.every = args.checkpoint_every
+        else:
+            checkpoint.remove()
+
+    print(
+        f"Opening DB {args.dbfile} with {args.dbsize} buckets, {args.format} format"
+        f" ({_start}: {_start - _start})",
+        file=sys.stderr,
+    )
+    db = open_db(
+        args.dbfile,
+        args.dbsize,
+        index_metadata(args),
+        args.offset_width,
+        args.align_pow,
+        truncate=not args.resume,
+    )
+    bloom = new_filter(args, args.dbsize)
+    if bloom is not None and args.resume:
+        refill_filter(db, bloom, args.format_version)
+
+    _opened = datetime.now(UTC)
+    if args.resume:
+        print(
+            f"DB open OK. Resuming after record {checkpoint.state['records']}"
+            f" ({_opened}: {_opened - _start})",
+            file=sys.stderr,
+        )
+    else:
+        print(f"DB open OK. Loading ({_opened}: {_opened - _start})", file=sys.stderr)
 
     # adding uniparc data
-    loaded_cnt, collisions = add_uniparc_data(db, sys.stdin, _start)
+    loaded_cnt, collisions = add_uniparc_data(db, stream, _start, args.format_version, bloom, checkpoint)
+    check_load_factor(db, args.dbfile, args.dbsize, args.max_load, _start)
     _loaded = datetime.now(UTC)
 
     # Closes the database.
@@ -128,11 +1143,31 @@ def main():
         file=sys.stderr,
     )
     db.Close().OrDie()
-    _closed = datetime.now(UTC)
-
+    save_filter(bloom, args.dbfile, _start)
+    if checkpoint:
+        checkpoint.remove()
     _closed = datetime.now(UTC)
     print(f"DB close OK ({_closed}: {_closed - _start})", file=sys.stderr)
 
 
+## MAIN ##
+def main():
+    args = get_args()
+
+    _start = datetime.now(UTC)
+    if args.inspect:
+        inspect_index(args)
+        return
+    if args.rebuild:
+        rebuild_index(args, _start)
+        return
+
+    if args.input:
+        with open(args.input, "r") as stream:
+            load(args, stream, _start)
+    else:
+        load(args, sys.stdin, _start)
+
+
 if __name__ == "__main__":
     main()
@@ -21,13 +21,20 @@ import argparse
 from datetime import datetime, UTC
 import sys
 
-import tkrzw
+from uniparc_dbm import UniParcIndex
 
 
 def get_args():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--dbfile", help="Database file to query.", required=True)
+    parser.add_argument(
+        "--dbfile",
+        help=(
+            "Database file (or index manifest) to query."
+            " Text and binary formats are both supported."
+        ),
+        required=True,
+    )
     parser.add_argument(
         "--batch",
         help="Default batch size to query for. Default is 5k",
@@ -35,17 +42,41 @@ def get_args():
         required=False,
         type=int,
     )
+    # In ordered mode, the output can be joined line by line with the input,
+    # without sorting either of them.
+    parser.add_argument(
+        "--ordered",
+        help=(
+            "Print one line per query, in the input order, using --miss_marker as value"
+            " for the md5s not found. By default, only the md5s found are printed."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--miss_marker",
+        help="Value printed for the md5s not found with --ordered. Default is '-'",
+        default="-",
+        required=False,
+    )
+    parser.add_argument(
+        "--no_sort",
+        help="Don't sort the md5s found in each batch before printing them.",
+        action="store_true",
+    )
 
     args = parser.parse_args()
     return args
 
 
-def dump(data, stream):
+def dump(data, stream, sort=True):
     if not data:
         return 0, 0
     found, non_unique = len(data), 0
 
-    for item in sorted(data.items(), key=lambda i: i[0]):
+    items = data.items()
+    if sort:
+        items = sorted(items, key=lambda i: i[0])
+    for item in items:
         decoded = list(map(lambda b: b.decode("utf-8"), item))
         if decoded[1].count("\t") > 0:
             non_unique += 1
@@ -54,17 +85,47 @@ def dump(data, stream):
     return found, non_unique
 
 
+def dump_ordered(queries, data, stream, miss_marker):
+    """Print one line per query, in the queries order"""
+    found, non_unique = 0, 0
+    lines = []
+    for key in queries:
+        value = data.get(key.encode("utf-8"))
+        if value is None:
+            lines.append(f"{key}\t{miss_marker}\n")
+            continue
+        value = value.decode("utf-8")
+        found += 1
+        if value.count("\t") > 0:
+            non_unique += 1
+        lines.append(f"{key}\t{value}\n")
+    stream.writelines(lines)
+
+    return found, non_unique
+
+
+def query_batch(db, queries, args, stream):
+    res = db.get_multi(queries)
+    if args.ordered:
+        return dump_ordered(queries, res, stream, args.miss_marker)
+    return dump(res, stream, sort=not args.no_sort)
+
+
 ## MAIN ##
 def main():
     args = get_args()
 
     _start = datetime.now(UTC)
     print(f"Opening DB {args.dbfile} ({_start}: {_start - _start})", file=sys.stderr)
-    db = tkrzw.DBM()
-    db.Open(args.dbfile, False, dbm="HashDBM", no_wait=True).OrDie()
+    db = UniParcIndex(args.dbfile)
+    db.open()
 
     _opened = datetime.now(UTC)
-    print(f"DB open OK. Quering ({_opened}: {_opened - _start})", file=sys.stderr)
+    print(
+        f"DB open OK ({db.num_shards} shard(s), filter {'on' if db.has_filters else 'off'})."
+        f" Quering ({_opened}: {_opened - _start})",
+        file=sys.stderr,
+    )
 
     # queadding uniparc data
     queried_cnt = 0
@@ -75,9 +136,8 @@ def main():
         key = line.strip().upper()
         queries.append(key)
         if cnt % args.batch == 0:
-            res = db.GetMulti(*queries)
+            _found, _non_unique = query_batch(db, queries, args, sys.stdout)
             queries = []
-            _found, _non_unique = dump(res, sys.stdout)
             found += _found
             non_unique += _non_unique
             _batch = datetime.now(UTC)
@@ -88,20 +148,22 @@ def main():
     queried_cnt = cnt
 
     # process last batch
-    res = db.GetMulti(*queries)
+    _found, _non_unique = query_batch(db, queries, args, sys.stdout)
     queries = []
-    _found, _non_unique = dump(res, sys.stdout)
     found += _found
     non_unique += _non_unique
 
     _queried = datetime.now(UTC)
 
+    if db.has_filters:
+        print(db.filter_stats, file=sys.stderr)
+
     # Closes the database.
     print(
         f"Queried {queried_cnt} times, found {found}, non unique {non_unique}. Closing DB ({_queried}: {_queried - _start})",
         file=sys.stderr,
     )
-    db.Close().OrDie()
+    db.close()
     _closed = datetime.now(UTC)
 
     _closed = datetime.now(UTC)
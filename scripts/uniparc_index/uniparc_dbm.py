@@ -0,0 +1,410 @@
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers shared by the UniParc md5 -> UPI index scripts.
+
+An index is either a single tkrzw DBM file (the historical layout), or a small
+JSON manifest describing a set of shard files living next to it. Callers only
+ever pass the path given as `--dbfile` to `create_uniparc_dbm.py`; `UniParcIndex`
+takes care of routing each key to the right shard.
+
+Each DB file also holds a metadata record (see `read_metadata`) with the
+format of its records:
+  * text (version 1): upper case hex md5 keys, UPIs as text, with colliding
+    UPIs joined with tabs. DB files without metadata use this format.
+  * binary (version 2): raw 16 bytes md5 keys, and UPIs packed as 5 bytes
+    big-endian integers (the 10 hex digits after "UPI"), simply concatenated
+    for collisions.
+
+A DB file can come with a Bloom filter of its md5s (`<dbfile>.filter`, see
+`Md5BloomFilter`), used to answer most misses without probing the DB.
+"""
+
+import binascii
+import json
+import math
+import mmap
+import os
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import tkrzw
+
+MANIFEST_FORMAT = "uniparc_dbm_manifest"
+MANIFEST_VERSION = 1
+
+# Shards are assigned by the first 4 hex digits (16 bits) of the md5, so that
+# each shard holds a contiguous md5 range.
+ROUTING_PREFIX_HEX = 4
+
+# The metadata record key: shorter than any md5 key and only made of null
+# bytes, so it is sorted before all of them (required for sorted DBs that are
+# written in order), and can't be asked for by a query.
+META_KEY = b"\x00"
+
+FORMAT_TEXT = 1
+FORMAT_BINARY = 2
+FORMATS = {"text": FORMAT_TEXT, "binary": FORMAT_BINARY}
+
+UPI_PREFIX = "UPI"
+UPI_HEX_LEN = 10
+UPI_BYTES = 5
+
+
+def read_metadata(db: tkrzw.DBM) -> Dict:
+    """Return the metadata of a DB file (empty for DBs created without metadata)."""
+    value = db.Get(META_KEY)
+    if value is None:
+        return {}
+    return json.loads(value.decode("utf-8"))
+
+
+def write_metadata(db: tkrzw.DBM, metadata: Dict) -> None:
+    db.Set(META_KEY, json.dumps(metadata, sort_keys=True).encode("utf-8"), True).OrDie()  # overwrite: True
+
+
+def format_version(metadata: Dict) -> int:
+    version = metadata.get("format_version", FORMAT_TEXT)
+    if version not in FORMATS.values():
+        raise ValueError(f"Unsupported index format version: {version}")
+    return version
+
+
+def encode_key(md5u: bytes, fmt: int) -> bytes:
+    """Encode an upper case hex md5 as a DB key."""
+    if fmt == FORMAT_BINARY:
+        return binascii.unhexlify(md5u)
+    return md5u
+
+
+def decode_key(key: bytes, fmt: int) -> bytes:
+    """Decode a DB key to an upper case hex md5."""
+    if fmt == FORMAT_BINARY:
+        return binascii.hexlify(key).upper()
+    return key
+
+
+def encode_upis(upis: List[str], fmt: int) -> bytes:
+    """Encode a list of UPIs as a DB value."""
+    if fmt == FORMAT_BINARY:
+        packed = []
+        for upi in upis:
+            if len(upi) != len(UPI_PREFIX) + UPI_HEX_LEN or not upi.startswith(UPI_PREFIX):
+                raise ValueError(f"Can't pack UPI '{upi}' in the binary format, use the text format")
+            packed.append(int(upi[len(UPI_PREFIX) :], 16).to_bytes(UPI_BYTES, "big"))
+        return b"".join(packed)
+    return "\t".join(upis).encode("utf-8")
+
+
+def join_values(prev: bytes, value: bytes, fmt: int) -> bytes:
+    """Append an encoded UPI to an existing DB value (collision)."""
+    if fmt == FORMAT_BINARY:
+        return prev + value
+    return b"\t".join([prev, value])
+
+
+def decode_value(value: bytes, fmt: int) -> bytes:
+    """Decode a DB value to tab separated UPIs."""
+    if fmt == FORMAT_BINARY:
+        prefix = UPI_PREFIX.encode("utf-8")
+        return b"\t".join(
+            b"%s%0*X" % (prefix, UPI_HEX_LEN, int.from_bytes(value[i : i + UPI_BYTES], "big"))
+            for i in range(0, len(value), UPI_BYTES)
+        )
+    return value
+
+
+def shard_index(md5u: bytes, num_shards: int) -> int:
+    """Return the shard number of an (upper case hex) md5 key."""
+    if num_shards == 1:
+        return 0
+    return (int(md5u[:ROUTING_PREFIX_HEX], 16) * num_shards) >> (4 * ROUTING_PREFIX_HEX)
+
+
+def shard_path(dbfile: str, idx: int) -> str:
+    """Path of a shard file, stored next to its manifest."""
+    return f"{dbfile}.shard{idx:03d}"
+
+
+def write_manifest(dbfile: str, manifest: Dict) -> None:
+    """Write the manifest describing a sharded index to `dbfile`.
+
+    Shard paths are stored relative to the manifest, so all the files can be
+    moved together.
+    """
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        **manifest,
+    }
+    manifest["shards"] = [os.path.basename(path) for path in manifest["shards"]]
+    tmp_file = f"{dbfile}.tmp"
+    with open(tmp_file, "w") as out:
+        json.dump(manifest, out, indent=2)
+        print(file=out)
+    os.replace(tmp_file, dbfile)
+
+
+def read_manifest(dbfile: str) -> Optional[Dict]:
+    """Load the manifest stored in `dbfile`.
+
+    Returns:
+        The manifest dict (with absolute shard paths), or None if `dbfile` is
+        a plain tkrzw DB file.
+    """
+    with open(dbfile, "rb") as data:
+        if data.read(1) != b"{":
+            return None
+    with open(dbfile, "r") as data:
+        manifest = json.load(data)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError(f"Unknown index manifest format in {dbfile}: {manifest.get('format')}")
+    if manifest.get("version", 0) > MANIFEST_VERSION:
+        raise ValueError(f"Unsupported index manifest version in {dbfile}: {manifest.get('version')}")
+    base_dir = os.path.dirname(os.path.abspath(dbfile))
+    manifest["shards"] = [os.path.join(base_dir, path) for path in manifest["shards"]]
+    return manifest
+
+
+class Md5BloomFilter:
+    """Bloom filter of md5 keys
+
+    The md5s are already uniformly distributed, so the bit positions are
+    derived from the md5 itself (double hashing of its two 64 bits halves),
+    with no extra hashing. With 8 bits per key, about 2% of the misses are
+    false positives.
+    """
+
+    MAGIC = b"UPBF"
+    HEADER = struct.Struct(">4sBQQ")  # magic, number of hashes, number of bits, number of keys
+
+    def __init__(self, num_bits: int, num_hashes: int, bits=None, num_keys: int = 0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.num_keys = num_keys
+
+    @classmethod
+    def for_keys(cls, expected_keys: int, bits_per_key: int = 8) -> "Md5BloomFilter":
+        num_bits = max(64, expected_keys * bits_per_key)
+        num_hashes = max(1, round(bits_per_key * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    @staticmethod
+    def path(dbfile: str) -> str:
+        return f"{dbfile}.filter"
+
+    def _positions(self, md5u) -> Iterator[int]:
+        """Bit positions of an (upper case hex) md5. Raises ValueError if it's not an md5."""
+        if len(md5u) != 32:
+            raise ValueError(f"Not an md5: {md5u}")
+        h1 = int(md5u[:16], 16)
+        h2 = int(md5u[16:], 16) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, md5u: bytes) -> None:
+        bits = self.bits
+        for pos in self._positions(md5u):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.num_keys += 1
+
+    def __contains__(self, md5u) -> bool:
+        bits = self.bits
+        try:
+            return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(md5u))
+        except ValueError:
+            return False
+
+    def save(self, path: str) -> None:
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "wb") as out:
+            out.write(self.HEADER.pack(self.MAGIC, self.num_hashes, self.num_bits, self.num_keys))
+            out.write(self.bits)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path: str, writable: bool = False) -> "Md5BloomFilter":
+        """Memory-map a filter file (read-only), or load it in memory to update it"""
+        with open(path, "rb") as data:
+            if writable:
+                mapped = data.read()
+            else:
+                mapped = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_hashes, num_bits, num_keys = cls.HEADER.unpack_from(mapped)
+        if magic != cls.MAGIC:
+            raise ValueError(f"Not a md5 Bloom filter file: {path}")
+        if writable:
+            bits = bytearray(mapped[cls.HEADER.size :])
+        else:
+            bits = memoryview(mapped)[cls.HEADER.size :]
+        return cls(num_bits, num_hashes, bits, num_keys)
+
+
+class FilterStats:
+    """Counters of the queries answered by the Bloom filters"""
+
+    def __init__(self):
+        self.queries = 0
+        self.filtered = 0
+        self.probed = 0
+        self.found = 0
+        self.bytes_saved = 0
+
+    @property
+    def false_positives(self) -> int:
+        return self.probed - self.found
+
+    def __str__(self) -> str:
+        if not self.queries:
+            return "filter: no queries"
+        return (
+            f"filter: {self.filtered} definite misses out of {self.queries} queries"
+            f" ({100 * self.filtered / self.queries:.1f}%), {self.found} hits,"
+            f" {self.false_positives} false positives, ~{self.bytes_saved} DB bytes not read"
+        )
+
+
+class UniParcIndex:
+    """Read-only access to a (possibly sharded) UniParc md5 -> UPI index"""
+
+    def __init__(self, dbfile: str):
+        self.dbfile = dbfile
+        self.manifest = read_manifest(dbfile)
+        if self.manifest:
+            self.paths = self.manifest["shards"]
+            self.dbm = self.manifest.get("dbm", "HashDBM")
+        else:
+            self.paths = [dbfile]
+            self.dbm = "HashDBM"
+        self.dbs: List[tkrzw.DBM] = []
+        self.formats: List[int] = []
+        self.filters: List[Optional[Md5BloomFilter]] = []
+        # Average number of bytes per record, to estimate what the filters save
+        self.record_sizes: List[int] = []
+        self.filter_stats = FilterStats()
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.paths)
+
+    def open(self) -> None:
+        for path in self.paths:
+            db = tkrzw.DBM()
+            db.Open(path, False, dbm=self.dbm, no_wait=True).OrDie()
+            self.dbs.append(db)
+            self.formats.append(format_version(read_metadata(db)))
+            filter_path = Md5BloomFilter.path(path)
+            if os.path.exists(filter_path):
+                self.filters.append(Md5BloomFilter.load(filter_path))
+            else:
+                self.filters.append(None)
+            self.record_sizes.append(os.path.getsize(path) // max(1, db.Count()))
+
+    @property
+    def has_filters(self) -> bool:
+        return any(self.filters)
+
+    def close(self) -> None:
+        for db in self.dbs:
+            db.Close().OrDie()
+        self.dbs = []
+        self.formats = []
+        self.filters = []
+        self.record_sizes = []
+
+    def iter_records(self) -> Iterator[Tuple[bytes, bytes]]:
+        """Iterate over all the records of the index, in the text format.
+
+        Yields:
+            Tuples of upper case hex md5, tab separated UPIs.
+        """
+        for db, fmt in zip(self.dbs, self.formats):
+            for key, value in db:
+                if key == META_KEY:
+                    continue
+                yield decode_key(key, fmt), decode_value(value, fmt)
+
+    def get_multi(self, keys: List[str]) -> Dict[bytes, bytes]:
+        """Query a batch of upper case md5 keys.
+
+        Returns:
+            A dict of the found keys and their values (as bytes), in the text
+            format whatever the format of the DB.
+        """
+        # Each key is only queried (and counted in the filter stats) once
+        keys = list(dict.fromkeys(keys))
+        if self.num_shards == 1:
+            return self._get_multi_shard(0, keys)
+
+        per_shard: Dict[int, List[str]] = {}
+        for key in keys:
+            try:
+                idx = shard_index(key, self.num_shards)
+            except ValueError:
+                # not an md5, can't be in the index: a definite miss, as for the filters
+                if self.has_filters:
+                    self.filter_stats.queries += 1
+                    self.filter_stats.filtered += 1
+                continue
+            per_shard.setdefault(idx, []).append(key)
+        res = {}
+        for idx, shard_keys in per_shard.items():
+            res.update(self._get_multi_shard(idx, shard_keys))
+        return res
+
+    def _get_multi_shard(self, idx: int, keys: List[str]) -> Dict[bytes, bytes]:
+        res = self._probe_shard(idx, self._filter_keys(idx, keys))
+        if self.filters[idx] is not None:
+            self.filter_stats.found += len(res)
+        return res
+
+    def _filter_keys(self, idx: int, keys: List[str]) -> List[str]:
+        """Remove the keys that the shard Bloom filter knows are missing"""
+        bloom = self.filters[idx]
+        if bloom is None:
+            return keys
+        kept = [key for key in keys if key in bloom]
+        stats = self.filter_stats
+        stats.queries += len(keys)
+        stats.probed += len(kept)
+        stats.filtered += len(keys) - len(kept)
+        stats.bytes_saved += (len(keys) - len(kept)) * self.record_sizes[idx]
+        return kept
+
+    def _probe_shard(self, idx: int, keys: List[str]) -> Dict[bytes, bytes]:
+        if not keys:
+            return {}
+        db, fmt = self.dbs[idx], self.formats[idx]
+        if fmt == FORMAT_TEXT:
+            res = db.GetMulti(*keys)
+            # The metadata record is not an md5 (e.g. a "\x00" query)
+            res.pop(META_KEY, None)
+            return res
+
+        encoded = {}
+        for key in keys:
+            try:
+                encoded_key = encode_key(key.encode("utf-8"), fmt)
+            except ValueError:
+                # not an md5, can't be in the index
+                continue
+            # e.g. "00" is unhexlified to the metadata record key
+            if encoded_key != META_KEY:
+                encoded[encoded_key] = key
+        return {
+            encoded[key].encode("utf-8"): decode_value(value, fmt)
+            for key, value in db.GetMulti(*encoded.keys()).items()
+        }
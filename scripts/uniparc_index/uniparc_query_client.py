@@ -0,0 +1,167 @@
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client for uniparc_query_server.py.
+
+Can be used as a library:
+
+    with UniParcQueryClient(socket_path="/tmp/uniparc.sock") as client:
+        upis = client.query(md5s)
+
+or as a drop-in replacement of query_uniparc_dbm.py, reading md5s from stdin:
+
+    python uniparc_query_client.py --socket /tmp/uniparc.sock < md5.lst > md5_upi.lst
+"""
+
+import argparse
+from datetime import datetime, UTC
+import socket
+import sys
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class UniParcQueryClient:
+    """Connection to a running UniParc query server"""
+
+    def __init__(self, socket_path: Optional[str] = None, port: Optional[int] = None, timeout: float = None):
+        """
+        Args:
+            socket_path: Unix socket of the server.
+            port: localhost TCP port of the server (if no socket_path).
+            timeout: socket timeout in seconds.
+        """
+        if bool(socket_path) == bool(port):
+            raise ValueError("Exactly one of socket_path or port is required")
+        self.socket_path = socket_path
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+        self.rfile = None
+        self.latencies: List[float] = []
+
+    def connect(self) -> None:
+        if self.socket_path:
+            self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.socket_path
+        else:
+            self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ("127.0.0.1", self.port)
+        self.conn.settimeout(self.timeout)
+        self.conn.connect(address)
+        self.rfile = self.conn.makefile("rb")
+
+    def close(self) -> None:
+        if self.conn:
+            self.rfile.close()
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def query_batch(self, md5s: List[str]) -> Dict[str, List[str]]:
+        """Send one request to the server.
+
+        Returns:
+            A dict of the md5s found (upper case), with their list of UPIs.
+        """
+        if not self.conn:
+            self.connect()
+        _request = time.perf_counter()
+        self.conn.sendall("".join(f"{md5}\n" for md5 in md5s).encode("utf-8") + b"\n")
+        res = {}
+        for line in self.rfile:
+            line = line.rstrip(b"\n")
+            if not line:
+                break
+            md5u, *upis = line.decode("utf-8").split("\t")
+            res[md5u] = upis
+        else:
+            raise ConnectionError("Connection closed by the UniParc query server")
+        self.latencies.append(time.perf_counter() - _request)
+        return res
+
+    def query(self, md5s: Iterable[str], batch: int = 5_000) -> Dict[str, List[str]]:
+        """Query md5s in batches.
+
+        Returns:
+            A dict of the md5s found (upper case), with their list of UPIs.
+        """
+        res = {}
+        queries = []
+        for md5 in md5s:
+            queries.append(md5.strip().upper())
+            if len(queries) == batch:
+                res.update(self.query_batch(queries))
+                queries = []
+        if queries:
+            res.update(self.query_batch(queries))
+        return res
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--socket", help="Unix socket of the query server.", required=False)
+    parser.add_argument("--port", help="localhost TCP port of the query server.", required=False, type=int)
+    parser.add_argument(
+        "--batch",
+        help="Default batch size to query for. Default is 5k",
+        default=5_000,
+        required=False,
+        type=int,
+    )
+
+    args = parser.parse_args()
+    if bool(args.socket) == bool(args.port):
+        parser.error("Exactly one of --socket or --port is required")
+    return args
+
+
+## MAIN ##
+def main():
+    args = get_args()
+
+    _start = datetime.now(UTC)
+    found, non_unique = 0, 0
+    with UniParcQueryClient(socket_path=args.socket, port=args.port) as client:
+        res = client.query(sys.stdin, args.batch)
+        for md5u, upis in sorted(res.items()):
+            found += 1
+            if len(upis) > 1:
+                non_unique += 1
+            print("\t".join([md5u, *upis]))
+
+    _queried = datetime.now(UTC)
+    latencies = sorted(client.latencies)
+    if latencies:
+        print(
+            f"{len(latencies)} requests, latency min {latencies[0] * 1000:.3f} ms,"
+            f" max {latencies[-1] * 1000:.3f} ms",
+            file=sys.stderr,
+        )
+    print(
+        f"Found {found}, non unique {non_unique} ({_queried}: {_queried - _start})",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
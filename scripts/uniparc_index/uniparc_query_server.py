@@ -0,0 +1,198 @@
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived query server for a UniParc md5 -> UPI index.
+
+The index is opened read-only once per worker process (tkrzw memory-maps the
+DB files, so the page cache is shared between the workers and stays warm
+between jobs). The workers are forked after the listening socket is created,
+and all accept connections from it.
+
+Protocol (one connection can send several requests):
+  * the client sends md5s, one per line, then an empty line;
+  * the server answers with one line per md5 found, in the same format as
+    query_uniparc_dbm.py (md5, then the tab separated UPIs), then an empty line.
+
+See uniparc_query_client.py for a client.
+"""
+
+import argparse
+from datetime import datetime, UTC
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from uniparc_dbm import UniParcIndex
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--dbfile",
+        help="Database file (or index manifest) to serve.",
+        required=True,
+    )
+    parser.add_argument(
+        "--socket",
+        help="Path of the Unix socket to listen to.",
+        required=False,
+    )
+    parser.add_argument(
+        "--port",
+        help="Listen to this TCP port on localhost instead of a Unix socket.",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of worker processes serving the queries. Default is 4",
+        default=4,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--quiet",
+        help="Don't report the latency of each request.",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    if bool(args.socket) == bool(args.port):
+        parser.error("Exactly one of --socket or --port is required")
+    return args
+
+
+def listen(args):
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(args.socket)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", args.port))
+    listener.listen(128)
+    return listener
+
+
+def handle(conn, index, quiet, _start):
+    """Serve all the requests of a client connection"""
+    rfile = conn.makefile("rb")
+    wfile = conn.makefile("wb")
+    keys = []
+    for line in rfile:
+        key = line.strip()
+        if key:
+            keys.append(key.upper().decode("utf-8"))
+            continue
+
+        # Empty line: end of the request
+        _request = time.perf_counter()
+        res = index.get_multi(keys)
+        for item in res.items():
+            wfile.write(b"\t".join(item) + b"\n")
+        wfile.write(b"\n")
+        wfile.flush()
+        _latency = time.perf_counter() - _request
+        if not quiet:
+            _served = datetime.now(UTC)
+            print(
+                f"[{os.getpid()}] Queried {len(keys)} times, found {len(res)} in {_latency * 1000:.3f} ms"
+                f" ({_served}: {_served - _start})",
+                file=sys.stderr,
+            )
+        keys = []
+
+
+def serve(listener, dbfile, quiet, _start):
+    """Worker process: open the index, then serve the connections one after the other"""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    index = UniParcIndex(dbfile)
+    index.open()
+    try:
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                try:
+                    handle(conn, index, quiet, _start)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+    finally:
+        index.close()
+
+
+## MAIN ##
+def main():
+    args = get_args()
+
+    _start = datetime.now(UTC)
+    listener = listen(args)
+    address = args.socket or f"127.0.0.1:{args.port}"
+    print(
+        f"Serving {args.dbfile} on {address} with {args.workers} workers ({_start}: {_start - _start})",
+        file=sys.stderr,
+    )
+
+    context = multiprocessing.get_context("fork")
+
+    def spawn():
+        worker = context.Process(target=serve, args=(listener, args.dbfile, args.quiet, _start), daemon=True)
+        worker.start()
+        return worker
+
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    workers = [spawn() for _ in range(args.workers)]
+    try:
+        while not stopping:
+            time.sleep(1)
+            # Replace the workers that died
+            for i, worker in enumerate(workers):
+                if not worker.is_alive() and not stopping:
+                    _died = datetime.now(UTC)
+                    print(
+                        f"Worker {worker.pid} exited with code {worker.exitcode}, restarting"
+                        f" ({_died}: {_died - _start})",
+                        file=sys.stderr,
+                    )
+                    workers[i] = spawn()
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        listener.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+    _stopped = datetime.now(UTC)
+    print(f"Server stopped ({_stopped}: {_stopped - _start})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()